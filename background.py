@@ -0,0 +1,82 @@
+import threading
+from contextlib import contextmanager
+from buffers import SegmentBuffer
+
+
+class TraceWorker:
+    # Runs the tracer on a daemon thread so the UI never waits on physics.
+    # Only the newest submitted job matters: a job still being traced when
+    # another arrives is abandoned through the tracer's should_stop hook.
+    # Results go into the back buffer and are swapped to the front only when
+    # complete, so the renderer always sees a whole trace. A job that raises
+    # leaves the front buffer as it was; the thread carries on with the next
+    # job and the error is raised again on the next read of `result`.
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.front = SegmentBuffer()
+        self.back = SegmentBuffer()
+        self._result = None
+        self.error = None
+        self.job = None
+        self.generation = 0
+        self.completed = 0
+        self.running = True
+        self.swap_lock = threading.Lock()
+        self.pending = threading.Condition()
+        self.tracer.should_stop = self.superseded
+        self.thread = threading.Thread(target=self.loop, name="trace-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, scene, rays):
+        # `scene` must not be touched by the caller afterwards; pass a
+        # Scene.snapshot().
+        with self.pending:
+            self.generation += 1
+            self.job = (self.generation, scene, rays)
+            self.pending.notify()
+
+    def superseded(self):
+        return self.job is not None or not self.running
+
+    def loop(self):
+        while True:
+            with self.pending:
+                while self.job is None and self.running:
+                    self.pending.wait()
+                if not self.running:
+                    return
+                generation, scene, rays = self.job
+                self.job = None
+
+            try:
+                result = self.tracer.solve_scene(scene, rays, out=self.back)
+            except Exception as error:
+                self.error = error
+                continue
+            if result.cancelled:
+                continue
+            with self.swap_lock:
+                self.front, self.back = self.back, self.front
+                self._result = result
+                self.completed = generation
+
+    @property
+    def result(self):
+        # The newest complete trace, unless a job has failed since the last
+        # read, in which case its error is raised here, once.
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+        return self._result
+
+    @contextmanager
+    def reading(self):
+        # Holds off the next swap while the caller reads the front buffer.
+        with self.swap_lock:
+            yield self.front
+
+    def stop(self):
+        with self.pending:
+            self.running = False
+            self.pending.notify()
+        self.thread.join(timeout=1.0)
@@ -0,0 +1,307 @@
+import math
+import heapq
+import itertools
+import numpy as np
+import constants
+from utils import Spectrum, get_spectrum_color
+from buffers import SegmentBuffer, pack_color
+from physics import RayHit, TraceResult
+from compiled import source_of
+from incremental import EditTracker, ray_key, split_trees
+
+
+def point_in_polygon(point, corners):
+    inside = False
+    j = len(corners) - 1
+    for i in range(len(corners)):
+        a, b = corners[i], corners[j]
+        if (a.y > point.y) != (b.y > point.y) and point.x < (b.x - a.x) * (point.y - a.y) / (b.y - a.y) + a.x:
+            inside = not inside
+        j = i
+    return inside
+
+
+class BeamEdge:
+    # One bounding ray of a beam, with the arguments cast_ray would take and
+    # the shape its origin lies on, if any (`source`). The two halves of a
+    # split beam share the edge between them, so its hit, its segment and
+    # its children are only worked out once, by whichever half gets there
+    # first.
+    def __init__(self, origin, direction, wavelength, intensity, medium, depth, parent, inside=None, source=None):
+        self.origin = origin
+        self.direction = direction
+        self.wavelength = wavelength
+        self.intensity = intensity
+        self.medium = medium
+        self.depth = depth
+        self.parent = parent
+        self.inside = inside
+        self.source = source
+        self.traced = False
+        self.hit = None
+        self.final = intensity
+        self.scattered = None
+        self.index = None
+        self.children = ()
+
+
+class BeamTracer:
+    # Traces runs of parallel source rays (a laser with beam_count > 1 and no
+    # spread) as one beam bounded by its two outermost rays. While both edges
+    # meet the same face of the same shape the beam stays whole and each
+    # bounce costs two rays whatever the beam's width; where the edges
+    # disagree it is bisected. Every coherent step writes its two edge
+    # segments and a filled quad to `out.beams`. Other rays go to `inner`.
+    # Beams are stepped with inner's engine (ParallelEngine's in-process
+    # one); an engine that cannot trace single rays gets every ray. As in
+    # IncrementalTracer, a beam no edit has touched is copied from the
+    # previous frame.
+    def __init__(self, inner):
+        self.inner = inner
+        engine = getattr(inner, "engine", inner)
+        engine = getattr(engine, "local", engine)
+        self.engine = engine if hasattr(engine, "scatter") else None
+        self.segment_budget = constants.SEGMENT_BUDGET
+        self.should_stop = None
+        self.beam_steps = 0
+        self.trees = {}
+        self.edits = EditTracker()
+        self.reused = 0
+
+    def group_rays(self, ray_origins):
+        # Consecutive rays sharing a direction, wavelength and intensity form
+        # one beam, given as the indices of its two outermost rays; the
+        # other rays are returned by index.
+        beams = []
+        singles = []
+        run = []
+        for i, ray in enumerate(ray_origins + [None]):
+            if run and ray is not None:
+                first = ray_origins[run[0]]
+                if (ray[1].x == first[1].x and ray[1].y == first[1].y and ray[2] == first[2]
+                        and ray[3] == first[3]):
+                    run.append(i)
+                    continue
+            if len(run) > 1:
+                beams.append((run[0], run[-1]))
+            else:
+                singles.extend(run)
+            run = [i] if ray is not None else []
+        return beams, singles
+
+    def solve_scene(self, scene, ray_origins, out=None):
+        out = SegmentBuffer() if out is None else out
+        ray_origins = list(ray_origins)
+        if self.engine is None:
+            beams, singles = [], list(range(len(ray_origins)))
+        else:
+            beams, singles = self.group_rays(ray_origins)
+
+        scene.get_bvh().reset_counters()
+        if singles or not beams:
+            self.inner.should_stop = self.should_stop
+            result = self.inner.solve_scene(scene, [ray_origins[i] for i in singles], out=out)
+            # Roots name their ray by its place among the singles.
+            roots = out.parent < 0
+            out.parent[roots] = -1 - np.array(singles, dtype=int)[-1 - out.parent[roots]]
+            if result.cancelled or not beams:
+                return TraceResult(out, result.culled_branches, result.cancelled, result.counters)
+            culled = result.culled_branches
+        else:
+            out.clear()
+            culled = 0
+
+        engine = self.engine
+        engine.object_index = {id(obj): i for i, obj in enumerate(scene.objects)}
+        engine.enclosing = engine.enclosing_shapes(scene)
+
+        edits = self.edits.collect(scene)
+        keys = [(ray_key(ray_origins[first]), ray_key(ray_origins[last])) for first, last in beams]
+        object_index = {id(source_of(obj)): i for i, obj in enumerate(scene.objects)}
+        kept = {}
+        fresh = []
+        for beam, key in zip(beams, keys):
+            tree = self.trees.get(key)
+            if tree is None or tree.touched(edits):
+                fresh.append((beam, key))
+                continue
+            tree.write(out, object_index, beam)
+            kept[key] = tree
+        self.trees = kept
+        self.edits.snapshot(scene)
+        self.reused = len(kept)
+
+        # Whatever the single rays and reused beams left of the budget.
+        start = len(out)
+        quad_start = len(out.beams)
+        budget = self.segment_budget - start
+        queue = []
+        order = itertools.count()
+        for (first, last), _ in fresh:
+            origin, direction, wavelength, intensity = ray_origins[first]
+            edge_origin = ray_origins[last][0]
+            medium = scene.env_material
+            self.push(queue, order, "beam", (BeamEdge(origin, direction, wavelength, intensity, medium, 0, -1 - first),
+                                             BeamEdge(edge_origin, direction, wavelength, intensity, medium, 0, -1 - last)))
+
+        self.beam_steps = 0
+        while queue:
+            if len(out) - start >= budget:
+                culled += len(queue)
+                break
+            self.beam_steps += 1
+            if self.should_stop is not None and self.beam_steps % 64 == 0 and self.should_stop():
+                return TraceResult(out, culled + len(queue), cancelled=True)
+            _, _, kind, item = heapq.heappop(queue)
+            if kind == "ray":
+                for child in self.finish(scene, item, out):
+                    self.push(queue, order, "ray", child)
+            else:
+                for kind, child in self.step(scene, item, out):
+                    self.push(queue, order, kind, child)
+
+        if fresh and not queue:
+            # Beams cut short by the budget are not kept, as in
+            # IncrementalTracer.
+            columns = out.columns(start)
+            columns["parent"] = np.where(columns["parent"] >= 0, columns["parent"] - start, columns["parent"])
+            quads = out.beams.columns(quad_start)
+            quads["parent"] = quads["parent"] - start
+            trees = split_trees(scene.objects, columns, [beam for beam, _ in fresh], quads)
+            self.trees.update(zip([key for _, key in fresh], trees))
+        return TraceResult(out, culled, counters=dict(scene.get_bvh().counters))
+
+    def push(self, queue, order, kind, item):
+        if kind == "ray":
+            depth, intensity = item.depth, item.intensity
+        else:
+            depth, intensity = item[0].depth, max(item[0].intensity, item[1].intensity)
+        if depth > constants.MAX_RECURSION or intensity < constants.MIN_INTENSITY:
+            return
+        heapq.heappush(queue, (-intensity, next(order), kind, item))
+
+    def surface(self, hit):
+        if hit.obj == "WALL":
+            return ("WALL", hit.normal.x, hit.normal.y)
+        return (id(hit.obj), hit.obj.feature_key(hit.point))
+
+    def obstructed(self, scene, quad, hit_obj, source):
+        # Is there a shape in the beam that neither edge ray touched? The
+        # edge rays met nothing before their hits, so such a shape crosses
+        # the beam's near or far side or lies wholly inside it. The near side
+        # runs along the shape the beam left and the far side along the face
+        # both edges hit, so neither is tested against its own shape.
+        min_x = min(p.x for p in quad)
+        min_y = min(p.y for p in quad)
+        max_x = max(p.x for p in quad)
+        max_y = max(p.y for p in quad)
+        for obj in scene.objects:
+            bounds = obj.get_bounds()
+            if bounds is None or bounds[0] > max_x or bounds[2] < min_x or bounds[1] > max_y or bounds[3] < min_y:
+                continue
+            if obj is not source and self.crosses(obj, quad[0], quad[1]):
+                return True
+            if obj is hit_obj:
+                continue
+            if self.crosses(obj, quad[2], quad[3]) or any(point_in_polygon(p, quad) for p in obj.anchor_points()):
+                return True
+        return False
+
+    def crosses(self, obj, a, b):
+        # Does the outline of obj cross the segment from a to b short of b?
+        length = a.distance_to(b)
+        if length <= self.engine.epsilon:
+            return False
+        t, _ = obj.get_intersection(a, (b - a) * (1.0 / length))
+        return t is not None and t < length - self.engine.epsilon
+
+    def trace(self, scene, edge):
+        # The edge's hit and its intensity on arrival, found once; as in
+        # cast_ray, a branch inside a shape looks for that shape's exit first.
+        if not edge.traced:
+            engine = self.engine
+            hit = None
+            if edge.inside is not None:
+                t, normal = edge.inside.get_intersection(edge.origin, edge.direction)
+                if t is not None and t > engine.epsilon:
+                    hit = RayHit(t, edge.origin + edge.direction * t, normal, edge.inside)
+            if hit is None:
+                hit = engine.find_closest_intersection(scene, edge.origin, edge.direction)
+            if hit is not None:
+                edge.final = edge.intensity * math.exp(-edge.medium.opacity * (hit.point.distance_to(edge.origin) / 100.0))
+            edge.hit = hit
+            edge.traced = True
+        return edge.hit
+
+    def scatter(self, scene, edge):
+        # Branches leaving the edge's hit, not yet tied to its segment.
+        if edge.scattered is None:
+            edge.scattered = ()
+            if edge.hit.obj != "WALL":
+                edge.scattered = self.engine.scatter(scene, edge.hit, edge.direction, edge.wavelength, edge.final,
+                                                     edge.medium, edge.depth, -1, edge.inside)
+        return edge.scattered
+
+    def emit(self, scene, edge, out):
+        # Writes the edge's segment unless a neighbouring beam already has,
+        # and makes its children; returns whether it was written now.
+        if edge.index is not None:
+            return False
+        hit = self.trace(scene, edge)
+        if hit is None:
+            end_point = edge.origin + edge.direction * constants.RAY_STEP
+            edge.index = self.engine.emit(out, edge.origin, end_point, edge.intensity, edge.wavelength, edge.depth, edge.parent)
+            return True
+        edge.index = self.engine.emit(out, edge.origin, hit.point, edge.final, edge.wavelength, edge.depth, edge.parent, hit.obj)
+        edge.children = [BeamEdge(*child[:6], edge.index, child[7], hit.obj) for child in self.scatter(scene, edge)]
+        return True
+
+    def finish(self, scene, edge, out):
+        # The edge on its own, as cast_ray would trace it. An edge some beam
+        # already wrote is carried on by that beam, so it ends here.
+        return edge.children if self.emit(scene, edge, out) else ()
+
+    def step(self, scene, beam, out):
+        # One bounce of a beam; returns (kind, item) for what follows.
+        l_edge, r_edge = beam
+        left = self.trace(scene, l_edge)
+        right = self.trace(scene, r_edge)
+
+        if left is None or right is None:
+            return [("ray", l_edge), ("ray", r_edge)]
+
+        coherent = (self.surface(left) == self.surface(right)
+                    and left.normal.dot(right.normal) >= math.cos(constants.BEAM_ARC_ANGLE)
+                    and not self.obstructed(scene, (l_edge.origin, r_edge.origin, right.point, left.point), left.obj,
+                                            l_edge.source))
+        if not coherent:
+            return self.split(beam)
+
+        if left.obj != "WALL":
+            l_children = self.scatter(scene, l_edge)
+            r_children = self.scatter(scene, r_edge)
+            paired = len(l_children) == len(r_children) and all(
+                lc[2] == rc[2] and lc[4] is rc[4] and lc[1].dot(rc[1]) > 0 for lc, rc in zip(l_children, r_children))
+            if not paired:
+                # Only one edge is past the critical angle, or dispersion
+                # splits the edges differently.
+                return self.split(beam)
+
+        self.emit(scene, l_edge, out)
+        self.emit(scene, r_edge, out)
+        wavelength = l_edge.wavelength
+        color = wavelength.color if isinstance(wavelength, Spectrum) else get_spectrum_color(wavelength)
+        out.beams.append(l_edge.origin, r_edge.origin, right.point, left.point, (l_edge.final + r_edge.final) / 2.0,
+                         pack_color(color), l_edge.depth, l_edge.index)
+
+        return [("beam", pair) for pair in zip(l_edge.children, r_edge.children)]
+
+    def split(self, beam):
+        l_edge, r_edge = beam
+        if l_edge.origin.distance_to(r_edge.origin) < constants.BEAM_MIN_WIDTH:
+            return [("ray", l_edge), ("ray", r_edge)]
+        # The middle edge bounds both halves: one object, traced once.
+        middle = BeamEdge((l_edge.origin + r_edge.origin) * 0.5, (l_edge.direction + r_edge.direction).normalize(),
+                          l_edge.wavelength, (l_edge.intensity + r_edge.intensity) / 2.0, l_edge.medium, l_edge.depth,
+                          l_edge.parent, l_edge.inside, l_edge.source)
+        return [("beam", (l_edge, middle)), ("beam", (middle, r_edge))]
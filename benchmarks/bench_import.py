@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each measurement runs in a fresh interpreter so nothing is cached.
+SNIPPET = """
+import sys, time
+start = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - start
+print(elapsed, 'pygame' in sys.modules)
+"""
+
+CASES = [
+    ("import physics", "import physics"),
+    ("tracing core", "import physics, objects, scene, wavefront, beams, incremental"),
+    ("core + rendering", "import physics, objects, scene, wavefront, beams, incremental, rendering"),
+    ("pygame alone", "import pygame"),
+]
+
+
+def measure(imports, repeat=7):
+    best = None
+    loaded = False
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", SNIPPET.format(imports=imports)], cwd=ROOT,
+                             capture_output=True, text=True, check=True,
+                             env=dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")).stdout.split()
+        elapsed = float(out[0])
+        loaded = out[1] == "True"
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e3, loaded
+
+
+if __name__ == "__main__":
+    for name, imports in CASES:
+        ms, loaded = measure(imports)
+        print(f"{name:17s}: {ms:7.1f} ms  pygame loaded: {'yes' if loaded else 'no'}")
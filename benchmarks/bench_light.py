@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+import constants
+from lightbuffer import LightBuffer
+
+# Drawing N random 5-60 px segments: one pygame.draw.line (plus a core line
+# for bright ones) per segment onto an SRCALPHA surface, as render used to
+# every frame, against rasterising them all into the LightBuffer and
+# tone-mapping once, which render now only does when the trace changes;
+# other frames just blit the result. Segments spread over the whole screen
+# and starting in a 256 px square, where only the rows they reach are
+# cleared and tone-mapped.
+COUNTS = [1000, 10000, 100000]
+W, H = constants.SCREEN_WIDTH, constants.SCREEN_HEIGHT
+AREAS = {"screen": (W, H), "local": (256, 256)}
+
+
+def segments(n, area=(W, H), seed=0):
+    rng = np.random.default_rng(seed)
+    x1 = rng.uniform(0, area[0], n)
+    y1 = rng.uniform(0, area[1], n)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    length = rng.uniform(5, 60, n)
+    intensity = rng.uniform(0, 1, n)
+    rgb = rng.integers(0, 256, (n, 3))
+    return x1, y1, x1 + length * np.cos(angle), y1 + length * np.sin(angle), intensity, rgb
+
+
+def per_line(surface, x1, y1, x2, y2, intensity, rgb):
+    ray_surface = pygame.Surface((W, H), pygame.SRCALPHA)
+    rows = zip(x1.astype(int).tolist(), y1.astype(int).tolist(), x2.astype(int).tolist(), y2.astype(int).tolist(),
+               intensity.tolist(), rgb.tolist())
+    for ax, ay, bx, by, i, color in rows:
+        alpha = int(i * 255)
+        if alpha < 5: continue
+        width = max(1, int(i * 4))
+        pygame.draw.line(ray_surface, tuple(color) + (alpha,), (ax, ay), (bx, by), width)
+        if width > 2:
+            pygame.draw.line(ray_surface, (255, 255, 255, alpha), (ax, ay), (bx, by), 1)
+    surface.blit(ray_surface, (0, 0))
+
+
+def buffered(surface, light, light_surface, x1, y1, x2, y2, intensity, rgb):
+    light.clear()
+    light.add_segments(x1, y1, x2, y2, intensity, rgb, np.maximum(1.0, np.floor(intensity * 4)))
+    light.draw(light_surface, constants.LIGHT_EXPOSURE)
+    surface.blit(light_surface, (0, 0), special_flags=pygame.BLEND_RGB_ADD)
+
+
+def measure(fn, *args, repeat=5):
+    # One untimed call first, so neither side pays for first-touch page
+    # faults or cold caches in its timings.
+    fn(*args)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e3
+
+
+if __name__ == "__main__":
+    pygame.init()
+    screen = pygame.display.set_mode((W, H))
+    light = LightBuffer(W, H)
+    light_surface = pygame.Surface((W, H))
+    for name, area in AREAS.items():
+        for n in COUNTS:
+            rows = segments(n, area)
+            before = measure(per_line, screen, *rows)
+            after = measure(buffered, screen, light, light_surface, *rows)
+            blit = measure(screen.blit, light_surface, (0, 0), None, pygame.BLEND_RGB_ADD)
+            print(f"{name:6s} {n:6d} segments: draw.line {before:8.1f} ms   light buffer {after:8.1f} ms   "
+                  f"blit {blit:5.1f} ms")
@@ -0,0 +1,43 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from materials import LIBRARY
+from utils import compute_spectrum_color, get_spectrum_color
+
+
+# Per-segment material/colour work done by PhysicsEngine.cast_ray: the IOR on
+# both sides of the interface plus the segment colour.
+WAVELENGTHS = [400 + (i / 9.0) * 300 for i in range(10)] + [650, 532.5]
+ENV = LIBRARY["AIR"]
+GLASS = LIBRARY["GLASS"]
+
+
+def per_segment_direct():
+    for wl in WAVELENGTHS:
+        ENV.compute_ior(wl)
+        GLASS.compute_ior(wl)
+        compute_spectrum_color(wl)
+
+
+def per_segment_tables():
+    for wl in WAVELENGTHS:
+        ENV.get_ior(wl)
+        GLASS.get_ior(wl)
+        get_spectrum_color(wl)
+
+
+def measure(fn, repeat=5, number=20000):
+    best = min(timeit.repeat(fn, repeat=repeat, number=number))
+    return best / (number * len(WAVELENGTHS)) * 1e9
+
+
+if __name__ == "__main__":
+    per_segment_tables()
+    before = measure(per_segment_direct)
+    after = measure(per_segment_tables)
+    print(f"direct formulas : {before:7.1f} ns/segment")
+    print(f"lookup tables   : {after:7.1f} ns/segment")
+    print(f"speedup         : {before / after:7.2f}x")
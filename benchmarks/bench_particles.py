@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import constants
+from main import LightLab, ParticlesSystem
+
+# Per-frame dust cost (update + draw) on the default scene in white-light
+# mode, once the segment grid for the trace exists.
+COUNTS = [100, 1000, 10000, 50000]
+
+
+def measure(app, particles, frames=20):
+    best = None
+    with app.trace_output() as segs:
+        particles.draw(app.screen, segs)
+        for _ in range(frames):
+            start = time.perf_counter()
+            particles.update()
+            particles.draw(app.screen, segs)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best * 1e3
+
+
+if __name__ == "__main__":
+    constants.BACKGROUND_TRACE = False
+    app = LightLab()
+    app.set_white_mode()
+    app.update_physics()
+    with app.trace_output() as segs:
+        start = time.perf_counter()
+        ParticlesSystem(1).draw(app.screen, segs)
+        print(f"segment grid     : {(time.perf_counter() - start) * 1e3:7.1f} ms  ({len(segs)} segments)")
+    for count in COUNTS:
+        print(f"{count:6d} particles: {measure(app, ParticlesSystem(count)):7.2f} ms/frame")
@@ -0,0 +1,152 @@
+import numpy as np
+
+
+def pack_color(color):
+    return (int(color[0]) << 16) | (int(color[1]) << 8) | int(color[2])
+
+
+def pack_colors(colors):
+    colors = np.asarray(colors, dtype=np.uint32)
+    return (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+
+
+def unpack_colors(packed):
+    packed = np.asarray(packed, dtype=np.uint32)
+    return np.stack(((packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF), axis=-1).astype(np.uint8)
+
+
+class ColumnBuffer:
+    # Rows stored column-wise, one NumPy array per entry of FIELDS. clear()
+    # only resets the row count, so a buffer kept across frames stops
+    # allocating once it has grown to the largest trace seen.
+    FIELDS = ()
+
+    def __init__(self, capacity=1024):
+        self.count = 0
+        self.capacity = capacity
+        self.version = 0
+        self.arrays = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.FIELDS}
+
+    def __len__(self):
+        return self.count
+
+    def __getattr__(self, name):
+        arrays = self.__dict__.get("arrays")
+        if arrays is not None and name in arrays:
+            return arrays[name][:self.count]
+        raise AttributeError(name)
+
+    def clear(self):
+        self.count = 0
+        self.version += 1
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        new_capacity = self.capacity
+        while new_capacity < capacity:
+            new_capacity *= 2
+        for name, dtype in self.FIELDS:
+            grown = np.zeros(new_capacity, dtype=dtype)
+            grown[:self.count] = self.arrays[name][:self.count]
+            self.arrays[name] = grown
+        self.capacity = new_capacity
+
+    def append_row(self, *values):
+        i = self.count
+        if i >= self.capacity:
+            self.reserve(i + 1)
+        for (name, _), value in zip(self.FIELDS, values):
+            self.arrays[name][i] = value
+        self.count = i + 1
+        return i
+
+    def extend(self, **columns):
+        n = len(columns[self.FIELDS[0][0]])
+        start = self.count
+        self.reserve(start + n)
+        for name, _ in self.FIELDS:
+            self.arrays[name][start:start + n] = columns[name]
+        self.count = start + n
+        return start
+
+    def columns(self, start=0, stop=None):
+        stop = self.count if stop is None else stop
+        return {name: self.arrays[name][start:stop] for name, _ in self.FIELDS}
+
+    def colors(self):
+        return unpack_colors(self.color)
+
+
+class BeamBuffer(ColumnBuffer):
+    # Filled beam quads from the beam tracer: (x1, y1) and (x2, y2) span the
+    # start of the beam, (x3, y3) and (x4, y4) its end, in outline order.
+    # `parent` is the segment row of the quad's first edge.
+    FIELDS = (
+        ("x1", np.float64),
+        ("y1", np.float64),
+        ("x2", np.float64),
+        ("y2", np.float64),
+        ("x3", np.float64),
+        ("y3", np.float64),
+        ("x4", np.float64),
+        ("y4", np.float64),
+        ("intensity", np.float64),
+        ("color", np.uint32),
+        ("depth", np.int32),
+        ("parent", np.int32),
+    )
+
+    def __init__(self, capacity=64):
+        super().__init__(capacity)
+
+    def append(self, p1, p2, p3, p4, intensity, color, depth, parent):
+        return self.append_row(p1.x, p1.y, p2.x, p2.y, p3.x, p3.y, p4.x, p4.y, intensity, color, depth, parent)
+
+
+class SegmentBuffer(ColumnBuffer):
+    # One row per traced segment. `parent` is the row of the segment it
+    # branched from, or -1 - i for the first segment of source ray i. `hit`
+    # is the index in scene.objects of the shape the segment ends on, or -1
+    # for walls and misses. Beam quads for the same trace live in `beams`
+    # and are cleared along with it.
+    FIELDS = (
+        ("x1", np.float64),
+        ("y1", np.float64),
+        ("x2", np.float64),
+        ("y2", np.float64),
+        ("intensity", np.float64),
+        ("wavelength", np.float64),
+        ("color", np.uint32),
+        ("depth", np.int32),
+        ("parent", np.int32),
+        ("hit", np.int32),
+    )
+
+    DTYPE = np.dtype([(name, dtype) for name, dtype in FIELDS])
+
+    def __init__(self, capacity=1024):
+        super().__init__(capacity)
+        self.beams = BeamBuffer()
+
+    def clear(self):
+        super().clear()
+        self.beams.clear()
+
+    def append(self, x1, y1, x2, y2, intensity, wavelength, color, depth, parent, hit=-1):
+        i = self.count
+        if i >= self.capacity:
+            self.reserve(i + 1)
+        a = self.arrays
+        a["x1"][i] = x1
+        a["y1"][i] = y1
+        a["x2"][i] = x2
+        a["y2"][i] = y2
+        a["intensity"][i] = intensity
+        a["wavelength"][i] = wavelength
+        a["color"][i] = color
+        a["depth"][i] = depth
+        a["parent"][i] = parent
+        a["hit"][i] = hit
+        self.count = i + 1
+        return i
@@ -0,0 +1,223 @@
+import math
+
+
+class BVHNode:
+    __slots__ = ("min_x", "min_y", "max_x", "max_y", "left", "right", "shape", "parent", "circle", "version")
+
+    def __init__(self, bounds, shape=None, parent=None):
+        self.min_x, self.min_y, self.max_x, self.max_y = bounds
+        self.left = None
+        self.right = None
+        self.shape = shape
+        self.parent = parent
+        self.circle = shape.get_prefilter_circle() if shape is not None else None
+        # The shape's version the box and circle were taken at.
+        self.version = shape.version if shape is not None else None
+
+    def set_bounds(self, bounds):
+        changed = bounds != (self.min_x, self.min_y, self.max_x, self.max_y)
+        self.min_x, self.min_y, self.max_x, self.max_y = bounds
+        return changed
+
+    def entry_distance(self, ox, oy, inv_x, inv_y):
+        # Slab test. Returns the ray parameter where the box is entered, or
+        # None when the ray misses it or the box lies entirely behind the origin.
+        if inv_x is None:
+            if ox < self.min_x or ox > self.max_x: return None
+            t_near, t_far = float('-inf'), float('inf')
+        else:
+            t1 = (self.min_x - ox) * inv_x
+            t2 = (self.max_x - ox) * inv_x
+            t_near, t_far = (t1, t2) if t1 < t2 else (t2, t1)
+
+        if inv_y is None:
+            if oy < self.min_y or oy > self.max_y: return None
+        else:
+            t1 = (self.min_y - oy) * inv_y
+            t2 = (self.max_y - oy) * inv_y
+            if t1 > t2: t1, t2 = t2, t1
+            if t1 > t_near: t_near = t1
+            if t2 < t_far: t_far = t2
+
+        if t_near > t_far or t_far < 0: return None
+        return t_near
+
+
+def union_bounds(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def rejection_rate(counters):
+    # Share of (ray, shape) pairs settled without an exact test, from a
+    # SceneBVH's counters or a trace's copy of them.
+    c = counters
+    return 1.0 - c["tested"] / c["candidates"] if c["candidates"] else 0.0
+
+
+class SceneBVH:
+    # Shapes are screened before their exact test: by the slab test on the
+    # boxes above them, by box entry distance against the best hit so far,
+    # and by a ray-vs-bounding-circle test that also compares its entry
+    # distance. `counters` keeps running totals until reset_counters().
+    def __init__(self, shapes):
+        self.leaves = {}
+        self.unbounded = []
+        self.reset_counters()
+        bounded = []
+        for shape in shapes:
+            bounds = shape.get_bounds()
+            if bounds is None:
+                self.unbounded.append(shape)
+            else:
+                bounded.append((shape, bounds))
+        self.root = self.build(bounded, None) if bounded else None
+
+    def build(self, items, parent):
+        if len(items) == 1:
+            shape, bounds = items[0]
+            node = BVHNode(bounds, shape, parent)
+            self.leaves[id(shape)] = node
+            return node
+
+        bounds = items[0][1]
+        for _, b in items[1:]:
+            bounds = union_bounds(bounds, b)
+        node = BVHNode(bounds, None, parent)
+
+        centers = [((b[0] + b[2]) * 0.5, (b[1] + b[3]) * 0.5) for _, b in items]
+        spread_x = max(c[0] for c in centers) - min(c[0] for c in centers)
+        spread_y = max(c[1] for c in centers) - min(c[1] for c in centers)
+        axis = 0 if spread_x >= spread_y else 1
+
+        order = sorted(range(len(items)), key=lambda i: centers[i][axis])
+        mid = len(items) // 2
+        node.left = self.build([items[i] for i in order[:mid]], node)
+        node.right = self.build([items[i] for i in order[mid:]], node)
+        return node
+
+    def reset_counters(self):
+        self.counters = {"queries": 0, "candidates": 0, "tested": 0, "circle_rejects": 0}
+
+    def contains(self, shape):
+        return id(shape) in self.leaves
+
+    def refit(self, shape):
+        # Recompute one leaf and walk towards the root, stopping as soon as an
+        # ancestor's box no longer changes.
+        node = self.leaves.get(id(shape))
+        if node is None:
+            return
+        node.set_bounds(shape.get_bounds())
+        node.circle = shape.get_prefilter_circle()
+        node.version = shape.version
+        node = node.parent
+        while node is not None:
+            left, right = node.left, node.right
+            bounds = (min(left.min_x, right.min_x), min(left.min_y, right.min_y),
+                      max(left.max_x, right.max_x), max(left.max_y, right.max_y))
+            if not node.set_bounds(bounds):
+                break
+            node = node.parent
+
+    def refit_stale(self):
+        # Refits every leaf whose shape has changed since its box was taken,
+        # however it was changed.
+        for node in list(self.leaves.values()):
+            if node.shape.version != node.version:
+                self.refit(node.shape)
+
+    def replaced(self, shapes):
+        # Copy of the tree with some shapes swapped for new versions of
+        # them; `shapes` maps id(old shape) to its replacement. Only the
+        # replaced leaves are refitted, and this tree is left as it was.
+        bvh = SceneBVH([])
+        bvh.unbounded = [shapes.get(id(shape), shape) for shape in self.unbounded]
+        bvh.root = bvh.copy_node(self.root, None, shapes) if self.root is not None else None
+        for shape in shapes.values():
+            bvh.refit(shape)
+        return bvh
+
+    def copy_node(self, node, parent, shapes):
+        copy = BVHNode((node.min_x, node.min_y, node.max_x, node.max_y), None, parent)
+        if node.shape is not None:
+            copy.shape = shapes.get(id(node.shape), node.shape)
+            copy.circle = node.circle
+            copy.version = node.version
+            self.leaves[id(copy.shape)] = copy
+        else:
+            copy.left = self.copy_node(node.left, copy, shapes)
+            copy.right = self.copy_node(node.right, copy, shapes)
+        return copy
+
+    def intersect(self, origin, direction, t_min, t_max=float('inf')):
+        closest_t = t_max
+        closest_normal = None
+        closest_shape = None
+
+        for shape in self.unbounded:
+            t, normal = shape.get_intersection(origin, direction)
+            if t is not None and t > t_min and t < closest_t:
+                closest_t, closest_normal, closest_shape = t, normal, shape
+
+        if self.root is None:
+            return closest_t, closest_normal, closest_shape
+
+        ox, oy = origin.x, origin.y
+        dx, dy = direction.x, direction.y
+        d2 = dx * dx + dy * dy
+        inv_x = 1.0 / dx if dx != 0 else None
+        inv_y = 1.0 / dy if dy != 0 else None
+        c = self.counters
+        c["queries"] += 1
+        c["candidates"] += len(self.leaves) + len(self.unbounded)
+        c["tested"] += len(self.unbounded)
+
+        t_root = self.root.entry_distance(ox, oy, inv_x, inv_y)
+        if t_root is None:
+            return closest_t, closest_normal, closest_shape
+
+        tested = circle_rejects = 0
+
+        stack = [(t_root, self.root)]
+        while stack:
+            t_enter, node = stack.pop()
+            if t_enter >= closest_t:
+                continue
+
+            if node.shape is not None:
+                circle = node.circle
+                if circle is not None:
+                    cx = circle[0] - ox
+                    cy = circle[1] - oy
+                    r2 = (circle[2] + 1e-6) ** 2
+                    proj = (cx * dx + cy * dy) / d2
+                    gap2 = r2 - (cx * cx + cy * cy - proj * proj * d2)
+                    if gap2 < 0:
+                        circle_rejects += 1
+                        continue
+                    if proj - math.sqrt(gap2 / d2) >= closest_t:
+                        circle_rejects += 1
+                        continue
+                tested += 1
+                t, normal = node.shape.get_intersection(origin, direction)
+                if t is not None and t > t_min and t < closest_t:
+                    closest_t, closest_normal, closest_shape = t, normal, node.shape
+                continue
+
+            t_left = node.left.entry_distance(ox, oy, inv_x, inv_y)
+            t_right = node.right.entry_distance(ox, oy, inv_x, inv_y)
+            if t_left is not None and t_right is not None:
+                if t_left <= t_right:
+                    stack.append((t_right, node.right))
+                    stack.append((t_left, node.left))
+                else:
+                    stack.append((t_left, node.left))
+                    stack.append((t_right, node.right))
+            elif t_left is not None:
+                stack.append((t_left, node.left))
+            elif t_right is not None:
+                stack.append((t_right, node.right))
+
+        c["tested"] += tested
+        c["circle_rejects"] += circle_rejects
+        return closest_t, closest_normal, closest_shape
\ No newline at end of file
@@ -0,0 +1,207 @@
+import copy
+import numpy as np
+from utils import Vector2D
+
+
+def source_of(obj):
+    # Shapes in a Scene.snapshot() stand in for the live shape they copy.
+    return getattr(obj, "source", obj)
+
+
+class CompiledScene:
+    # Every shape in a scene flattened into contiguous NumPy arrays of
+    # primitives: arcs (circles and spherical lens faces) and line
+    # segments, each tagged with its part. A part is one simple shape; its
+    # owner is the scene index of the object it came from (a compound has
+    # several parts) and its material is an index into `materials`. One
+    # call intersects any number of rays with every primitive at once.
+    # Instances are never modified; a changed scene gets a new one that
+    # reuses the rows of every shape whose version is unchanged.
+    def __init__(self, objects, key, previous=None):
+        self.key = key
+        self.objects = objects
+        old_blocks = previous.blocks if previous is not None else {}
+        self.blocks = {}
+
+        arcs = []
+        segments = []
+        arc_part = []
+        segment_part = []
+        part_owner = []
+        part_material = []
+        self.materials = []
+        material_ids = {}
+        self.opaque = []
+        self.loose = []
+        polygon_parts = []
+        polygon_rows = []
+        polygon_starts = []
+        circle_parts = []
+
+        for owner, obj in enumerate(objects):
+            source = source_of(obj)
+            block = old_blocks.get(id(source))
+            if block is None or block[0] is not source or block[1] != obj.version:
+                block = (source, obj.version, self.compile_shape(obj))
+            self.blocks[id(source)] = block
+
+            for part, part_arcs, part_segments in block[2]:
+                index = len(part_owner)
+                part_owner.append(owner)
+                if id(part.material) not in material_ids:
+                    material_ids[id(part.material)] = len(self.materials)
+                    self.materials.append(part.material)
+                part_material.append(material_ids[id(part.material)])
+
+                if part_arcs is None:
+                    self.opaque.append((index, part))
+                    self.loose.append((index, part))
+                    continue
+                if len(part_arcs) == 0 and len(part_segments):
+                    # A closed run of segments: inside-tests by crossing count.
+                    polygon_parts.append(index)
+                    polygon_rows.extend(range(len(segments), len(segments) + len(part_segments)))
+                    polygon_starts.append(len(polygon_rows) - len(part_segments))
+                elif len(part_arcs) == 1 and len(part_segments) == 0 and part_arcs[0][5] < -1.0:
+                    circle_parts.append((index, len(arcs)))
+                else:
+                    self.loose.append((index, part))
+                arcs.extend(part_arcs)
+                arc_part.extend([index] * len(part_arcs))
+                segments.extend(part_segments)
+                segment_part.extend([index] * len(part_segments))
+
+        self.arcs = np.array(arcs, dtype=float).reshape(-1, 7)
+        self.segments = np.array(segments, dtype=float).reshape(-1, 7)
+        self.arc_part = np.array(arc_part, dtype=int)
+        self.segment_part = np.array(segment_part, dtype=int)
+        self.part_owner = np.array(part_owner + [-1], dtype=int)
+        self.part_material = np.array(part_material + [-1], dtype=int)
+
+        self.polygon_parts = np.array(polygon_parts, dtype=int)
+        self.polygon_segments = self.segments[np.array(polygon_rows, dtype=int)]
+        self.polygon_starts = np.array(polygon_starts, dtype=int)
+        self.circle_parts = np.array([p for p, _ in circle_parts], dtype=int)
+        self.circles = self.arcs[[a for _, a in circle_parts]][:, :3] if circle_parts else np.zeros((0, 3))
+
+    def compile_shape(self, obj):
+        parts = []
+        for part in obj.world_parts():
+            primitives = part.primitives()
+            if primitives is None:
+                parts.append((part, None, None))
+            else:
+                parts.append((part, tuple(primitives[0]), tuple(primitives[1])))
+        return parts
+
+    def bind(self, objects):
+        # The same arrays, answering with the shapes of another scene
+        # holding the same objects (e.g. a snapshot and its live scene).
+        if objects is self.objects:
+            return self
+        view = copy.copy(self)
+        view.objects = objects
+        return view
+
+    def __len__(self):
+        return len(self.arcs) + len(self.segments) + len(self.opaque)
+
+    def intersect(self, ox, oy, dx, dy, t_min):
+        # Nearest hit beyond t_min for every ray, as arrays (t, nx, ny,
+        # owner, material); owner and material are -1 and t is inf on a miss.
+        n = len(ox)
+        inf = float('inf')
+        best_t = np.full(n, inf)
+        best_nx = np.zeros(n)
+        best_ny = np.zeros(n)
+        best_part = np.full(n, -1)
+        rows = np.arange(n)
+
+        if len(self.arcs):
+            cx, cy, r, ux, uy, cos_min, side = self.arcs.T
+            ocx = ox[:, None] - cx
+            ocy = oy[:, None] - cy
+            a = (dx * dx + dy * dy)[:, None]
+            b = 2.0 * (ocx * dx[:, None] + ocy * dy[:, None])
+            c = ocx * ocx + ocy * ocy - r * r
+            disc = b * b - 4 * a * c
+            root = np.sqrt(np.maximum(disc, 0.0))
+            t = np.full(disc.shape, inf)
+            for sign in (1.0, -1.0):
+                candidate = (-b + sign * root) / (2 * a)
+                hx = ocx + dx[:, None] * candidate
+                hy = ocy + dy[:, None] * candidate
+                on_arc = (disc >= 0) & (candidate > 0.001) & (candidate > t_min) & (hx * ux + hy * uy >= (cos_min - 1e-9) * r)
+                t = np.where(on_arc & (candidate < t), candidate, t)
+            k = np.argmin(t, axis=1)
+            arc_t = t[rows, k]
+            closer = arc_t < best_t
+            reached = np.where(closer, arc_t, 0.0)
+            hx = ocx[rows, k] + dx * reached
+            hy = ocy[rows, k] + dy * reached
+            scale = np.where(closer, side[k] / r[k], 0.0)
+            best_t = np.where(closer, arc_t, best_t)
+            best_nx = np.where(closer, hx * scale, best_nx)
+            best_ny = np.where(closer, hy * scale, best_ny)
+            best_part = np.where(closer, self.arc_part[k], best_part)
+
+        if len(self.segments):
+            p1x, p1y, ex, ey, enx, eny, len_sq = self.segments.T
+            denom = enx * dx[:, None] + eny * dy[:, None]
+            safe = np.where(np.abs(denom) < 1e-6, 1.0, denom)
+            t = ((p1x - ox[:, None]) * enx + (p1y - oy[:, None]) * eny) / safe
+            proj = (ox[:, None] + dx[:, None] * t - p1x) * ex + (oy[:, None] + dy[:, None] * t - p1y) * ey
+            valid = (np.abs(denom) >= 1e-6) & (t > t_min) & (proj >= 0) & (proj <= len_sq)
+            t = np.where(valid, t, inf)
+            k = np.argmin(t, axis=1)
+            segment_t = t[rows, k]
+            closer = segment_t < best_t
+            best_t = np.where(closer, segment_t, best_t)
+            best_nx = np.where(closer, enx[k], best_nx)
+            best_ny = np.where(closer, eny[k], best_ny)
+            best_part = np.where(closer, self.segment_part[k], best_part)
+
+        for index, part in self.opaque:
+            for i in range(n):
+                t, normal = part.get_intersection(Vector2D(ox[i], oy[i]), Vector2D(dx[i], dy[i]))
+                if t is not None and t > t_min and t < best_t[i]:
+                    best_t[i] = t
+                    best_nx[i] = normal.x
+                    best_ny[i] = normal.y
+                    best_part[i] = index
+
+        return best_t, best_nx, best_ny, self.part_owner[best_part], self.part_material[best_part]
+
+    def inside_parts(self, px, py):
+        # (points, parts) array: which parts contain which points.
+        inside = np.zeros((len(px), len(self.part_owner) - 1), dtype=bool)
+        if len(self.polygon_parts):
+            ax, ay, ex, ey = self.polygon_segments[:, :4].T
+            by = ay + ey
+            py_ = py[:, None]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                crosses = ((ay > py_) != (by > py_)) & (px[:, None] < ex * (py_ - ay) / ey + ax)
+            inside[:, self.polygon_parts] = np.add.reduceat(crosses.astype(int), self.polygon_starts, axis=1) % 2 == 1
+        if len(self.circle_parts):
+            cx, cy, r = self.circles.T
+            inside[:, self.circle_parts] = np.hypot(px[:, None] - cx, py[:, None] - cy) < r
+        for index, part in self.loose:
+            for i in range(len(px)):
+                inside[i, index] = part.contains(Vector2D(px[i], py[i]))
+        return inside
+
+    def contains(self, px, py):
+        # Scene index of the topmost object containing each point, or -1.
+        inside = self.inside_parts(px, py)
+        if inside.shape[1] == 0:
+            return np.full(len(px), -1)
+        return np.where(inside, self.part_owner[:-1], -1).max(axis=1)
+
+    def objects_at(self, point):
+        # Every object containing `point`, bottom first.
+        inside = self.inside_parts(np.array([point.x]), np.array([point.y]))[0]
+        return [self.objects[i] for i in sorted(set(self.part_owner[:-1][inside].tolist()))]
+
+    def pick(self, point):
+        owner = self.contains(np.array([point.x]), np.array([point.y]))[0]
+        return self.objects[owner] if owner >= 0 else None
@@ -19,4 +19,28 @@ PIXELS_PER_METER = 2000.0
 MAX_RECURSION = 12
 MIN_INTENSITY = 0.005  
 RAY_STEP = 5000
+SEGMENT_BUDGET = 4000
+WHITE_LIGHT_BINS = 50
+SPECTRAL_SPLIT_ANGLE = 0.001
+ADAPTIVE_INITIAL_RAYS = 9
+ADAPTIVE_RAY_BUDGET = 64
+ADAPTIVE_MIN_ANGLE = 0.002
+ADAPTIVE_PROBE_HITS = 4
+BEAM_TRACE = True
+CONVEX_FAST_PATH = True
+SHOW_TRACE_STATS = False
+SHOW_LAYER_STATS = False
+SPRITE_CACHE_BYTES = 32 * 1024 * 1024
+PREFILTER_MIN_EDGES = 6
+EDGE_INDEX_MIN_EDGES = 32
+BEAM_ARC_ANGLE = 0.05
+BEAM_MIN_WIDTH = 2.0
+PHYSICS_ENGINE = "scalar"
+INCREMENTAL_TRACE = True
+BACKGROUND_TRACE = True
+PARALLEL_WORKERS = 4
+PARALLEL_MIN_RAYS = 64
+DUST_PARTICLES = 100
+DUST_GRID_CELL = 16.0
+LIGHT_EXPOSURE = 2.0
 SPEED_OF_LIGHT = 299792458
\ No newline at end of file
@@ -0,0 +1,115 @@
+import math
+
+
+class EdgeGrid:
+    # Uniform grid over a polygon's local bounds. Each cell lists the edges
+    # whose bounding boxes touch it, and each row lists the edges spanning
+    # its height. Rays walk the cells they cross in order and stop once the
+    # best hit lies inside the cells already visited; point tests only look
+    # at the edges of one row. Works for concave outlines too.
+    def __init__(self, edges):
+        self.edges = edges
+        xs = [x for e in edges for x in (e[0], e[0] + e[2])]
+        ys = [y for e in edges for y in (e[1], e[1] + e[3])]
+        pad = 1e-6 * max(1.0, max(xs) - min(xs), max(ys) - min(ys))
+        self.min_x = min(xs) - pad
+        self.min_y = min(ys) - pad
+        self.max_x = max(xs) + pad
+        self.max_y = max(ys) + pad
+
+        self.cols = self.rows = max(1, int(math.ceil(math.sqrt(len(edges)))))
+        self.cell_w = (self.max_x - self.min_x) / self.cols
+        self.cell_h = (self.max_y - self.min_y) / self.rows
+
+        self.cells = [[] for _ in range(self.cols * self.rows)]
+        self.row_edges = [[] for _ in range(self.rows)]
+        for i, (p1x, p1y, ex, ey, nx, ny, edge_len_sq) in enumerate(edges):
+            c0, c1 = sorted((self.col_of(p1x), self.col_of(p1x + ex)))
+            r0, r1 = sorted((self.row_of(p1y), self.row_of(p1y + ey)))
+            for r in range(r0, r1 + 1):
+                self.row_edges[r].append(i)
+                for c in range(c0, c1 + 1):
+                    self.cells[r * self.cols + c].append(i)
+
+    def col_of(self, x):
+        return min(self.cols - 1, max(0, int((x - self.min_x) / self.cell_w)))
+
+    def row_of(self, y):
+        return min(self.rows - 1, max(0, int((y - self.min_y) / self.cell_h)))
+
+    def intersect(self, ox, oy, dx, dy):
+        # Same result as testing every edge: (t, edge index) of the nearest
+        # crossing with t >= 0, or (inf, -1).
+        inf = float('inf')
+        t_near, t_far = 0.0, inf
+        for o, d, lo, hi in ((ox, dx, self.min_x, self.max_x), (oy, dy, self.min_y, self.max_y)):
+            if d == 0:
+                if o < lo or o > hi:
+                    return inf, -1
+                continue
+            t1 = (lo - o) / d
+            t2 = (hi - o) / d
+            if t1 > t2:
+                t1, t2 = t2, t1
+            t_near = max(t_near, t1)
+            t_far = min(t_far, t2)
+        if t_near > t_far:
+            return inf, -1
+
+        col = self.col_of(ox + dx * t_near)
+        row = self.row_of(oy + dy * t_near)
+        step_c = 1 if dx > 0 else -1
+        step_r = 1 if dy > 0 else -1
+        delta_c = self.cell_w / abs(dx) if dx != 0 else inf
+        delta_r = self.cell_h / abs(dy) if dy != 0 else inf
+        next_c = (self.min_x + (col + (dx > 0)) * self.cell_w - ox) / dx if dx != 0 else inf
+        next_r = (self.min_y + (row + (dy > 0)) * self.cell_h - oy) / dy if dy != 0 else inf
+
+        edges = self.edges
+        seen = set()
+        closest_t = inf
+        closest_edge = -1
+        while True:
+            for i in self.cells[row * self.cols + col]:
+                if i in seen:
+                    continue
+                seen.add(i)
+                p1x, p1y, ex, ey, nx, ny, edge_len_sq = edges[i]
+                denom = nx * dx + ny * dy
+                if abs(denom) < 1e-6: continue
+
+                t = ((p1x - ox) * nx + (p1y - oy) * ny) / denom
+                if t < 0: continue
+
+                proj = (ox + dx * t - p1x) * ex + (oy + dy * t - p1y) * ey
+                if proj >= 0 and proj <= edge_len_sq and t < closest_t:
+                    closest_t = t
+                    closest_edge = i
+
+            if next_c < next_r:
+                if closest_t <= next_c:
+                    break
+                col += step_c
+                next_c += delta_c
+                if col < 0 or col >= self.cols:
+                    break
+            else:
+                if closest_t <= next_r:
+                    break
+                row += step_r
+                next_r += delta_r
+                if row < 0 or row >= self.rows:
+                    break
+        return closest_t, closest_edge
+
+    def contains(self, px, py):
+        # Crossing count along +x, over the edges of the point's row only.
+        if px < self.min_x or px > self.max_x or py < self.min_y or py > self.max_y:
+            return False
+        inside = False
+        for i in self.row_edges[self.row_of(py)]:
+            ax, ay, ex, ey = self.edges[i][:4]
+            by = ay + ey
+            if (ay > py) != (by > py) and px < ex * (py - ay) / ey + ax:
+                inside = not inside
+        return inside
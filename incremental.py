@@ -0,0 +1,250 @@
+import numpy as np
+from buffers import SegmentBuffer
+from physics import TraceResult
+from compiled import source_of
+
+
+def boxes_overlap(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def ray_key(ray):
+    origin, direction, wavelength, intensity = ray
+    return (origin.x, origin.y, direction.x, direction.y, wavelength, intensity)
+
+
+class TraceTree:
+    # Everything some source rays produced on their last trace: their
+    # segments (parents re-based to the tree, roots naming their ray by its
+    # place among the tree's rays, `hit` re-based to hit_objects), any beam
+    # quads (`parent` re-based the same way), the shapes hit and the box
+    # around the whole lot.
+    def __init__(self, columns, hit_objects, quads=None):
+        self.columns = columns
+        self.hit_objects = hit_objects
+        self.hit_ids = {id(obj) for obj in hit_objects}
+        self.quads = quads
+        xs = [columns["x1"], columns["x2"]]
+        ys = [columns["y1"], columns["y2"]]
+        if quads is not None:
+            xs += [quads[name] for name in ("x1", "x2", "x3", "x4")]
+            ys += [quads[name] for name in ("y1", "y2", "y3", "y4")]
+        if len(columns["x1"]):
+            self.bounds = (
+                float(min(x.min() for x in xs)),
+                float(min(y.min() for y in ys)),
+                float(max(x.max() for x in xs)),
+                float(max(y.max() for y in ys)),
+            )
+        else:
+            self.bounds = None
+
+    def __len__(self):
+        return len(self.columns["x1"])
+
+    def crosses(self, box):
+        # Conservative corridor test: does any segment's or quad's bounding
+        # box touch `box`?
+        if self.bounds is None or not boxes_overlap(self.bounds, box):
+            return False
+        c = self.columns
+        if np.any((np.minimum(c["x1"], c["x2"]) <= box[2]) & (np.maximum(c["x1"], c["x2"]) >= box[0]) &
+                  (np.minimum(c["y1"], c["y2"]) <= box[3]) & (np.maximum(c["y1"], c["y2"]) >= box[1])):
+            return True
+        if self.quads is None:
+            return False
+        q = self.quads
+        xs = np.stack([q["x1"], q["x2"], q["x3"], q["x4"]])
+        ys = np.stack([q["y1"], q["y2"], q["y3"], q["y4"]])
+        return bool(np.any((xs.min(axis=0) <= box[2]) & (xs.max(axis=0) >= box[0]) &
+                           (ys.min(axis=0) <= box[3]) & (ys.max(axis=0) >= box[1])))
+
+    def touched(self, edits):
+        # Could the edits from EditTracker.collect() have changed this tree?
+        if edits is None:
+            return True
+        edited, regions = edits
+        return bool(self.hit_ids & edited) or any(self.crosses(box) for box in regions)
+
+    def write(self, out, object_index, rays):
+        # Appends the tree to `out` for the source rays at indices `rays`;
+        # object_index maps a shape's id to its index in the current scene.
+        start = out.count
+        columns = dict(self.columns)
+        parent = columns["parent"]
+        columns["parent"] = np.where(parent >= 0, parent + start, -1 - np.asarray(rays)[np.maximum(-1 - parent, 0)])
+        hit_index = np.array([object_index.get(id(obj), -1) for obj in self.hit_objects] + [-1])
+        columns["hit"] = hit_index[columns["hit"]]
+        out.extend(**columns)
+        if self.quads is not None and len(self.quads["parent"]):
+            quads = dict(self.quads)
+            quads["parent"] = quads["parent"] + start
+            out.beams.extend(**quads)
+
+
+def split_trees(objects, columns, groups, quads=None):
+    # One TraceTree per group of source rays (a tuple of ray indices) from
+    # the columns of a trace of them: each segment goes to the group of the
+    # ray it descends from and each quad to that of its segment. Segments
+    # of rays in no group are dropped.
+    parent = columns["parent"]
+    count = len(parent)
+    # Every segment inherits the tree of its parent, and a root's parent
+    # names its source ray. Roots come out in intensity order, and rays too
+    # dim to trace have none, so they are matched by that and not by their
+    # position.
+    tree = np.where(parent < 0, np.arange(count), parent)
+    while True:
+        jumped = tree[tree]
+        if np.array_equal(jumped, tree):
+            break
+        tree = jumped
+    ray = -1 - parent[tree]
+
+    ray_count = max([max(rays) for rays in groups] + [int(ray.max()) if count else 0]) + 1
+    group_of = np.full(ray_count, -1)
+    place = np.zeros(ray_count, dtype=int)
+    for g, rays in enumerate(groups):
+        group_of[list(rays)] = g
+        place[list(rays)] = np.arange(len(rays))
+    owner = group_of[ray]
+
+    order = np.argsort(owner, kind='stable')
+    starts = np.searchsorted(owner[order], np.arange(len(groups) + 1))
+    local = np.empty(count, dtype=int)
+    local[order] = np.arange(count) - starts[np.maximum(owner[order], 0)]
+    if quads is not None:
+        quad_owner = owner[quads["parent"]]
+
+    trees = []
+    for g in range(len(groups)):
+        rows = order[starts[g]:starts[g + 1]]
+        tree_columns = {name: values[rows].copy() for name, values in columns.items()}
+        tree_parent = tree_columns["parent"]
+        tree_columns["parent"] = np.where(tree_parent >= 0, local[np.maximum(tree_parent, 0)], -1 - place[ray[rows]])
+        hits = np.unique(tree_columns["hit"])
+        hits = hits[hits >= 0]
+        hit_objects = [source_of(objects[h]) for h in hits.tolist()]
+        tree_columns["hit"] = np.where(tree_columns["hit"] >= 0, np.searchsorted(hits, tree_columns["hit"]), -1)
+        tree_quads = None
+        if quads is not None:
+            picked = quad_owner == g
+            tree_quads = {name: values[picked].copy() for name, values in quads.items()}
+            tree_quads["parent"] = local[tree_quads["parent"]]
+        trees.append(TraceTree(tree_columns, hit_objects, tree_quads))
+    return trees
+
+
+class EditTracker:
+    # Remembers each shape's version and bounds as of the last trace, to
+    # tell which shapes have been edited since and where they were.
+    def __init__(self):
+        self.shapes = {}
+        self.env_material = None
+
+    def collect(self, scene):
+        # Returns (ids of edited shapes, boxes they covered before or after
+        # the edit), or None when everything must be traced again.
+        if scene.env_material is not self.env_material:
+            return None
+
+        edited = set()
+        regions = []
+        current = {}
+        for obj in scene.objects:
+            source = source_of(obj)
+            bounds = obj.get_bounds()
+            current[id(source)] = bounds
+            previous = self.shapes.get(id(source))
+            if previous is not None and previous[0] is source and previous[1] == obj.version:
+                continue
+            if previous is not None and previous[0] is not source:
+                return None
+            if bounds is None or (previous is not None and previous[2] is None):
+                return None
+            edited.add(id(source))
+            regions.append(bounds)
+            if previous is not None:
+                regions.append(previous[2])
+
+        for key, (obj, version, bounds) in self.shapes.items():
+            if key not in current:
+                if bounds is None:
+                    return None
+                edited.add(key)
+                regions.append(bounds)
+        return edited, regions
+
+    def snapshot(self, scene):
+        self.shapes = {id(source_of(obj)): (source_of(obj), obj.version, obj.get_bounds()) for obj in scene.objects}
+        self.env_material = scene.env_material
+
+
+class IncrementalTracer:
+    # Wraps an engine and keeps one TraceTree per source ray. After an edit,
+    # only trees that hit an edited shape or pass through its old or new
+    # bounds are traced again; the rest are copied from the previous frame.
+    def __init__(self, engine):
+        self.engine = engine
+        self.should_stop = None
+        self.trees = {}
+        self.edits = EditTracker()
+        self.scratch = SegmentBuffer()
+        self.retraced = 0
+        self.reused = 0
+
+    def solve_scene(self, scene, ray_origins, out=None):
+        out = SegmentBuffer() if out is None else out
+        edits = self.edits.collect(scene)
+        keys = [ray_key(ray) for ray in ray_origins]
+
+        stale = []
+        for i, key in enumerate(keys):
+            tree = self.trees.get(key)
+            if tree is None or tree.touched(edits):
+                stale.append(i)
+
+        kept = {key: self.trees[key] for key in keys if key in self.trees}
+        for i in stale:
+            kept.pop(keys[i], None)
+        reused_segments = sum(len(tree) for tree in kept.values())
+
+        frame_trees = dict(kept)
+        culled = 0
+        cancelled = False
+        counters = None
+        if stale:
+            budget = max(0, self.engine.segment_budget - reused_segments)
+            traced, culled, cancelled, counters = self.retrace(scene, [ray_origins[i] for i in stale],
+                                                     [keys[i] for i in stale], budget)
+            frame_trees.update(traced)
+            if culled == 0 and not cancelled:
+                # Trees cut short by the budget are not kept, so they are
+                # traced again in full once the budget allows.
+                kept.update(traced)
+        self.trees = kept
+        self.edits.snapshot(scene)
+        self.retraced = len(stale)
+        self.reused = len(keys) - len(stale)
+
+        out.clear()
+        object_index = {id(source_of(obj)): i for i, obj in enumerate(scene.objects)}
+        for i, key in enumerate(keys):
+            tree = frame_trees.get(key)
+            if tree is None:
+                culled += 1
+                continue
+            tree.write(out, object_index, (i,))
+        return TraceResult(out, culled, cancelled, counters)
+
+    def retrace(self, scene, rays, keys, budget):
+        saved_budget = self.engine.segment_budget
+        self.engine.segment_budget = budget
+        self.engine.should_stop = self.should_stop
+        try:
+            result = self.engine.solve_scene(scene, rays, out=self.scratch)
+        finally:
+            self.engine.segment_budget = saved_budget
+
+        trees = split_trees(scene.objects, self.scratch.columns(), [(i,) for i in range(len(keys))])
+        return dict(zip(keys, trees)), result.culled_branches, result.cancelled, result.counters
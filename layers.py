@@ -0,0 +1,21 @@
+import pygame
+
+
+class Layer:
+    # One cached surface of the frame. `paint` redraws it, and only runs
+    # when the key describing everything the layer shows has changed since
+    # the last time; `redraws` counts how often that happened.
+    def __init__(self, size, alpha=False):
+        self.surface = pygame.Surface(size, pygame.SRCALPHA if alpha else 0)
+        self.alpha = alpha
+        self.key = None
+        self.redraws = 0
+
+    def update(self, key, paint):
+        if key != self.key:
+            if self.alpha:
+                self.surface.fill((0, 0, 0, 0))
+            paint(self.surface)
+            self.key = key
+            self.redraws += 1
+        return self.surface
@@ -0,0 +1,239 @@
+import numpy as np
+import pygame
+from utils import clip
+
+
+class LightBuffer:
+    # Additive float32 radiance at screen resolution, one plane per colour
+    # channel, stored row by row like a surface's pixels. Segments and beam
+    # quads are rasterised in bulk and their light summed per pixel, so
+    # overlapping beams add up instead of the last one painting over the
+    # rest; draw() then tone-maps the sum, rolling it off smoothly towards
+    # full brightness, straight into a surface's pixels, and leaves the
+    # buffer clear for the next frame. Only the rows drawn to since the last
+    # clear() (`dirty`) are swept, and when few of their pixels were drawn
+    # to, only those pixels.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.radiance = np.zeros((3, width * height), dtype=np.float32)
+        self.image = np.empty(self.radiance.shape, dtype=np.uint8)
+        # Pixel indices of every batch drawn since clear(), repeats and all.
+        self.marks = []
+        self.marked = 0
+        self.dirty = None
+        # The surface draw() last drew to and the pixels it lit there: its
+        # dirty rows, or the marks when it went pixel by pixel.
+        self.surface = None
+        self.shown = None
+
+    def clear(self):
+        if self.dirty is None:
+            return
+        self.radiance[:, self.rows()] = 0.0
+        self.marks = []
+        self.marked = 0
+        self.dirty = None
+
+    def mark(self, index, y0, y1):
+        # Records drawing to pixels `index`, all in rows y0 to y1 inclusive.
+        self.marks.append(index)
+        self.marked += len(index)
+        if self.dirty is not None:
+            y0, y1 = min(y0, self.dirty[0]), max(y1, self.dirty[1] - 1)
+        self.dirty = (int(y0), int(y1) + 1)
+
+    def rows(self):
+        return slice(self.dirty[0] * self.width, self.dirty[1] * self.width)
+
+    def sparse(self):
+        # Going pixel by pixel costs a few times more per pixel than
+        # sweeping the dirty rows, repeats included.
+        return self.marked * 3 < (self.dirty[1] - self.dirty[0]) * self.width
+
+    def add(self, index, weights):
+        # Sums weights[c][i] into channel c of pixel index[i]. np.add.at
+        # beats a screen-sized bincount at any batch size, as long as the
+        # weights are already float32 like the buffer.
+        for channel, w in enumerate(weights):
+            np.add.at(self.radiance[channel], index, w.astype(np.float32, copy=False))
+
+    def add_segments(self, x1, y1, x2, y2, intensity, rgb, width):
+        # Anti-aliased lines `width` pixels across, laying down `intensity`
+        # per pixel along their length. Each line is sampled at every pixel
+        # centre along its major axis (u); at each sample the pixels across
+        # the minor axis (v) get the part of the line's footprint they cover.
+        sx, sy = x2 - x1, y2 - y1
+        # Clipped to the screen, so every sample's footprint is at least
+        # partly on it.
+        t0, t1 = clip(x1, y1, sx, sy, 0, 0, self.width, self.height)
+        keep = np.flatnonzero((t0 < t1) & ((sx != 0) | (sy != 0)) & (intensity > 0) & (width > 0))
+        ax, ay = x1[keep] + sx[keep] * t0[keep], y1[keep] + sy[keep] * t0[keep]
+        # Lines starting near one another go in one after the other, so
+        # their light lands on parts of the buffer that are still in cache.
+        order = np.argsort(np.floor(ay * (1 / 16.0)) * (self.width + 1) + ax)
+        keep, ax, ay = keep[order], ax[order], ay[order]
+        bx, by = x1[keep] + sx[keep] * t1[keep], y1[keep] + sy[keep] * t1[keep]
+        light = (intensity[keep] / 255.0 * rgb[keep].T).astype(np.float32)
+        width = width[keep]
+
+        steep = np.abs(by - ay) > np.abs(bx - ax)
+        # Steep lines walk rows instead: same code with x and y swapped.
+        for flip in (False, True):
+            pick = np.flatnonzero(steep == flip)
+            if not len(pick):
+                continue
+            au, av, bu, bv = (ay, ax, by, bx) if flip else (ax, ay, bx, by)
+            au, av, bu, bv = au[pick], av[pick], bu[pick], bv[pick]
+            lines, spans = (self.height, self.width) if flip else (self.width, self.height)
+
+            first = np.clip(np.ceil(np.minimum(au, bu) - 0.5), 0, lines).astype(int)
+            last = np.clip(np.floor(np.maximum(au, bu) - 0.5), -1, lines - 1).astype(int)
+            count = np.maximum(last - first + 1, 0)
+            ends = np.cumsum(count)
+            if not ends[-1]:
+                continue
+            # Per sample work is done in 32 bits: positions on screen need
+            # nothing like float64's precision.
+            u = np.arange(ends[-1], dtype=np.int32)
+            u -= np.repeat((ends - count - first).astype(np.int32), count)
+            slope = (bv - av) / (bu - au)
+            # Half the footprint along v, so it is width across the line.
+            half = 0.5 * width[pick] * np.sqrt(1.0 + slope * slope)
+            centre = av + (0.5 - au) * slope
+
+            # The footprint [a, b] on screen, v - half to v + half at the
+            # sample, covers pixels low to high - 1: wholly except for the
+            # partial first and last ones.
+            rise = np.repeat(slope.astype(np.float32), count)
+            rise *= u
+            a = np.repeat((centre - half).astype(np.float32), count)
+            a += rise
+            np.maximum(a, 0.0, out=a)
+            b = np.repeat((centre + half).astype(np.float32), count)
+            b += rise
+            np.minimum(b, spans, out=b)
+            low = a.astype(np.int32)
+            ceiling = np.ceil(b)
+            high = ceiling.astype(np.int32)
+            run = high - low
+            stops = np.cumsum(run, dtype=np.intp)
+            starts = stops - run
+            cover = np.empty(stops[-1], dtype=np.float32)
+            cover.fill(1.0)
+            b -= ceiling
+            b += 1.0
+            cover[stops - 1] = b
+            b += ceiling
+            b -= 1.0
+            low += 1
+            np.minimum(low, b, out=b)
+            low -= 1
+            b -= a
+            cover[starts] = b
+
+            # Pixel (x, y) is at y * width + x; the pixels of a sample's run
+            # are `stride` apart, so the index steps by that within a run
+            # and jumps to the next run's first pixel between them.
+            stride = 1 if flip else self.width
+            if flip:
+                head = u * self.width
+                head += low
+            else:
+                head = low * self.width
+                head += u
+            jump = np.diff(head)
+            jump -= (run[:-1] - 1) * stride
+            index = np.empty(stops[-1], dtype=np.intp)
+            index.fill(stride)
+            index[starts[1:]] = jump
+            index[0] = head[0]
+            np.cumsum(index, out=index)
+            # A line's pixels follow one another, so its light is repeated
+            # straight from the line rather than through its samples.
+            pixels = np.diff(np.concatenate(([0], stops))[ends], prepend=0)
+            weights = np.repeat(light[:, pick], pixels, axis=1)
+            weights *= cover
+            self.add(index, weights)
+            if flip:
+                self.mark(index, first.min(), last.max())
+            else:
+                reach = np.minimum(av, bv) - half, np.maximum(av, bv) + half
+                self.mark(index, max(int(reach[0].min()), 0), min(int(reach[1].max()), self.height - 1))
+
+    def add_quads(self, xs, ys, intensity, rgb):
+        # Filled convex quads ((n, 4) corner arrays in outline order),
+        # `intensity` per covered pixel. Each covered row is filled between
+        # the outermost crossings of the outline at its centre.
+        first = np.clip(np.ceil(ys.min(axis=1) - 0.5), 0, self.height).astype(int)
+        last = np.clip(np.floor(ys.max(axis=1) - 0.5), -1, self.height - 1).astype(int)
+        count = np.maximum(last - first + 1, 0)
+        quad = np.repeat(np.arange(len(xs)), count)
+        row = first[quad] + np.arange(len(quad)) - np.repeat(np.cumsum(count) - count, count)
+        yc = row + 0.5
+
+        left = np.full(len(quad), np.inf)
+        right = np.full(len(quad), -np.inf)
+        for k in range(4):
+            qx, qy = xs[quad, k], ys[quad, k]
+            rx, ry = xs[quad, (k + 1) % 4], ys[quad, (k + 1) % 4]
+            crosses = (qy <= yc) != (ry <= yc)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = np.where(crosses, qx + (yc - qy) * (rx - qx) / (ry - qy), np.nan)
+            left = np.fmin(left, x)
+            right = np.fmax(right, x)
+
+        low = np.clip(np.ceil(left - 0.5), 0, self.width).astype(int)
+        high = np.clip(np.floor(right - 0.5), -1, self.width - 1).astype(int)
+        run = np.where(np.isfinite(left), np.maximum(high - low + 1, 0), 0)
+        span = np.repeat(np.arange(len(quad)), run)
+        if not len(span):
+            return
+        column = low[span] + np.arange(len(span)) - np.repeat(np.cumsum(run) - run, run)
+        owner = quad[span]
+        rows = row[span]
+        index = rows * self.width + column
+        self.add(index, (intensity[owner] * rgb[owner, channel] / 255.0 for channel in range(3)))
+        self.mark(index, rows.min(), rows.max())
+
+    def shade(self, radiance, scratch, image, pixels, exposure, shifts):
+        # 255 * (1 - exp(-exposure * radiance)) per channel, packed into
+        # 32-bit pixels with each 8-bit channel shifted into place.
+        np.multiply(radiance, -exposure, out=scratch)
+        np.expm1(scratch, out=scratch)
+        np.multiply(scratch, -255.0, out=scratch)
+        np.copyto(image, scratch, casting='unsafe')
+        np.left_shift(image[0], shifts[0], out=pixels, dtype=np.uint32)
+        for channel in (1, 2):
+            pixels |= np.left_shift(image[channel], shifts[channel], dtype=np.uint32)
+
+    def draw(self, surface, exposure):
+        # Tone-maps the light onto `surface`, a 32-bit surface of the
+        # buffer's size that nothing else draws to: only what the last
+        # draw() to it lit up is blacked out again, everything else stays.
+        pixels = np.reshape(pygame.surfarray.pixels2d(surface).T, -1, copy=False)
+        for shown in [slice(None)] if surface is not self.surface else self.shown:
+            pixels[shown] = 0
+        self.surface = surface
+        self.shown = []
+        if self.dirty is None:
+            return
+        shifts = surface.get_shifts()
+        rows = self.rows()
+        if self.sparse():
+            self.shown = self.marks
+            for index in self.marks:
+                radiance = self.radiance.take(index, axis=1)
+                lit = np.empty(len(index), dtype=np.uint32)
+                self.shade(radiance, radiance, np.empty(radiance.shape, dtype=np.uint8), lit, exposure, shifts)
+                pixels[index] = lit
+                for channel in range(3):
+                    self.radiance[channel][index] = 0.0
+        else:
+            self.shown = [rows]
+            radiance = self.radiance[:, rows]
+            self.shade(radiance, radiance, self.image[:, rows], pixels[rows], exposure, shifts)
+            radiance.fill(0.0)
+        self.marks = []
+        self.marked = 0
+        self.dirty = None
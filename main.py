@@ -1,68 +1,89 @@
 import pygame 
 import math
-import random
+import multiprocessing
+from contextlib import nullcontext
+import numpy as np
 
 import constants
-from utils import Vector2D
+from utils import Vector2D, Spectrum
 from materials import LIBRARY as MATERIALS_LIBRARY
 from physics import PhysicsEngine
+from wavefront import WavefrontEngine
+from incremental import IncrementalTracer
+from parallel import ParallelEngine
+from background import TraceWorker
+from sampling import AdaptiveFan
+from beams import BeamTracer
 from objects import Polygon, CircleLens, LaserSource
+from scene import Scene
+from bvh import rejection_rate
+from buffers import SegmentBuffer
+from segmentgrid import SegmentGrid
+from lightbuffer import LightBuffer
+from layers import Layer
+from rendering import SPRITES
 from ui import UIButton, UISlider
 
-
-class Scene:
-    def __init__(self):
-        self.objects = []
-        self.env_material = MATERIALS_LIBRARY["AIR"]
-
+ENGINES = {
+    "scalar": PhysicsEngine,
+    "wavefront": WavefrontEngine,
+    "parallel": ParallelEngine,
+}
 
 
 class ParticlesSystem:
-    def __init__(self):
-        self.particles = []
-        for i in range(100):
-          self.particles.append({
-              "pos": Vector2D(random.randint(0, constants.SCREEN_WIDTH), random.randint(0, constants.SCREEN_HEIGHT)),
-              'vel': Vector2D(random.uniform(-0.2, 0.2), random.uniform(-0.2, 0.2)),
-              'size': random.uniform(1,2)
-          })
-
+    # Dust as parallel arrays, moved, lit and drawn all at once. Each
+    # particle is lit by the exact distance to the segments a SegmentGrid,
+    # rebuilt only when the trace changes, lists near it.
+    def __init__(self, count=None):
+        count = constants.DUST_PARTICLES if count is None else count
+        self.x = np.random.randint(0, constants.SCREEN_WIDTH + 1, count).astype(float)
+        self.y = np.random.randint(0, constants.SCREEN_HEIGHT + 1, count).astype(float)
+        self.vx = np.random.uniform(-0.2, 0.2, count)
+        self.vy = np.random.uniform(-0.2, 0.2, count)
+        self.size = np.random.uniform(1, 2, count)
+        self.grid = None
+        self.grid_key = None
 
     def update(self):
-        for p in self.particles:
-            p['pos'] = p['pos'] + p['vel']
-            if p['pos'].x < 0: p['pos'].x = constants.SCREEN_WIDTH
-            if p['pos'].x > constants.SCREEN_WIDTH: p['pos'].x = 0
-            if p['pos'].y < 0: p['pos'].y = constants.SCREEN_HEIGHT
-            if p['pos'].y > constants.SCREEN_HEIGHT: p['pos'].y = 0
-
-
-
-    def draw(self, surface, rays):
-        for p in self.particles:
-            brightness = 20
-
-
-            for r in rays:
-                l2 = r.p1.distance_to(r.p2)**2
-                if l2 == 0: continue
-                t = ((p['pos'].x - r.p1.x) * (r.p2.x - r.p1.x) + (p['pos'].y - r.p1.y) * (r.p2.y - r.p1.y)) / l2
-                t = max(0, min(1, t))
-                proj = r.p1 + (r.p2 - r.p1) * t
-                dist = p['pos'].distance_to(proj)
-
-                if dist < 10:
-                    brightness = min(255, brightness + 200 * (1.0 - dist/10.0) * r.intensity)
-            
-            col = (brightness, brightness, brightness)
-            if brightness > 30:
-                pygame.draw.circle(surface, col, p['pos'].to_int_tuple(), 1)
+        self.x += self.vx
+        self.y += self.vy
+        self.x = np.where(self.x < 0, constants.SCREEN_WIDTH, np.where(self.x > constants.SCREEN_WIDTH, 0, self.x))
+        self.y = np.where(self.y < 0, constants.SCREEN_HEIGHT, np.where(self.y > constants.SCREEN_HEIGHT, 0, self.y))
+
+    def draw(self, surface, segments):
+        # The grid only changes with the trace it indexes.
+        key = (id(segments), segments.version, len(segments))
+        if key != self.grid_key:
+            self.grid = SegmentGrid(segments.x1, segments.y1, segments.x2, segments.y2, 10.0,
+                                    constants.SCREEN_WIDTH, constants.SCREEN_HEIGHT, constants.DUST_GRID_CELL)
+            self.grid_key = key
+        points, segs, dist = self.grid.distances(self.x, self.y)
+        near = dist < 10
+        contribution = 200 * (1.0 - dist[near] / 10.0) * segments.intensity[segs[near]]
+        brightness = np.minimum(255, 20 + np.bincount(points[near], weights=contribution, minlength=len(self.x)))
+
+        lit = brightness > 30
+        if not lit.any():
+            return
+        x = self.x[lit].astype(int)
+        y = self.y[lit].astype(int)
+        shade = brightness[lit].astype(np.uint8)
+        # Each mote is the 2x2 block a radius-1 circle covers.
+        pixels = pygame.surfarray.pixels3d(surface)
+        width, height = pixels.shape[:2]
+        for dx, dy in ((-1, -1), (0, -1), (-1, 0), (0, 0)):
+            px = x + dx
+            py = y + dy
+            on = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+            pixels[px[on], py[on]] = shade[on, None]
+        del pixels
 
 
 
 
 class LightLab:
-    def __init__(self):
+    def __init__(self, engine=None):
         pygame.init()
         self.screen = pygame.display.set_mode((constants.SCREEN_WIDTH, constants.SCREEN_HEIGHT))
         pygame.display.set_caption("Professional Physics Engine v2.0")
@@ -70,8 +91,25 @@ class LightLab:
 
         self.scene = Scene()
         self.laser = LaserSource(100, constants.SCREEN_HEIGHT // 2)
-        self.engine = PhysicsEngine()
+        self.engine = ENGINES[engine or constants.PHYSICS_ENGINE]()
+        self.tracer = IncrementalTracer(self.engine) if constants.INCREMENTAL_TRACE else self.engine
+        if constants.BEAM_TRACE:
+            self.tracer = BeamTracer(self.tracer)
         self.particles = ParticlesSystem()
+        self.light = LightBuffer(constants.SCREEN_WIDTH, constants.SCREEN_HEIGHT)
+        size = (constants.SCREEN_WIDTH, constants.SCREEN_HEIGHT)
+        # Bottom to top; the dust goes between background and shapes, and
+        # only the panel's own strip of its layer is used.
+        self.layers = {
+            "background": Layer(size),
+            "shapes": Layer(size, alpha=True),
+            "rays": Layer(size),
+            "panel": Layer(size),
+        }
+        self.segments = SegmentBuffer()
+        self.white_light = Spectrum.white(constants.WHITE_LIGHT_BINS)
+        self.sampler = AdaptiveFan()
+        self.worker = TraceWorker(self.tracer) if constants.BACKGROUND_TRACE else None
 
         self.widgets = []
         self.build_ui()
@@ -82,15 +120,19 @@ class LightLab:
 
         self.load_default_scene()
         self.rays = []
+        self.trace_key = None
+        self.trace_counters = None
+        self.stats_font = pygame.font.SysFont("Segoe UI", 12)
+        self.info_font = pygame.font.SysFont("Arial", 16)
 
     def load_default_scene(self):
         prism_verts = [(-60, 50), (60, 50), (0, -50)]
-        self.scene.objects.append(Polygon(500, 450, MATERIALS_LIBRARY["GLASS"], prism_verts))
+        self.scene.add(Polygon(500, 450, MATERIALS_LIBRARY["GLASS"], prism_verts))
 
         block_verts = [(-50, -80), (50, -80), (50, 80), (-50, 80)]
-        self.scene.objects.append(Polygon(800, 450, MATERIALS_LIBRARY["WATER"], block_verts))
+        self.scene.add(Polygon(800, 450, MATERIALS_LIBRARY["WATER"], block_verts))
 
-        self.scene.objects.append(CircleLens(650, 200, MATERIALS_LIBRARY["DIAMOND"], 60))
+        self.scene.add(CircleLens(650, 200, MATERIALS_LIBRARY["DIAMOND"], 60))
 
     def build_ui(self):
         p_x = constants.SCREEN_WIDTH - 280
@@ -104,6 +146,8 @@ class LightLab:
         self.widgets.append(UISlider(p_x, y, 250, 1, 10, 1, "Beam Count", self.set_beam_count))
         y += 60
         self.widgets.append(UISlider(p_x, y, 250, 0, 20, 0, "Spread (Deg)", self.set_spread))
+        y += 50
+        self.widgets.append(UIButton(p_x, y, 250, 35, "Adaptive Fan", self.toggle_adaptive))
 
         y += 60
         self.widgets.append(UIButton(p_x, y, 250, 35, "Clear Scene", self.clear_scene))
@@ -131,7 +175,8 @@ class LightLab:
     def set_single_mode(self): self.laser.beam_count = 1
     def set_beam_count(self, val): self.laser.beam_count = int(val)
     def set_spread(self, val): self.laser.spread = val
-    def clear_scene(self): self.scene.objects = []
+    def toggle_adaptive(self): self.laser.adaptive = not self.laser.adaptive
+    def clear_scene(self): self.scene.clear()
     def toggle_env(self):
         if self.scene.env_material.name == "Air":
             self.scene.env_material = MATERIALS_LIBRARY["WATER"]
@@ -143,11 +188,11 @@ class LightLab:
     def add_obj(self, type):
         cx, cy = constants.SCREEN_WIDTH/2, constants.SCREEN_HEIGHT/2
         if type == 'prism':
-            self.scene.objects.append(Polygon(cx, cy, MATERIALS_LIBRARY["GLASS"], [(-60,50),(60,50),(0,-50)]))
+            self.scene.add(Polygon(cx, cy, MATERIALS_LIBRARY["GLASS"], [(-60,50),(60,50),(0,-50)]))
         elif type == 'block':
-            self.scene.objects.append(Polygon(cx, cy, MATERIALS_LIBRARY["GLASS"], [(-50,-50),(50,-50),(50,50),(-50,50)]))
+            self.scene.add(Polygon(cx, cy, MATERIALS_LIBRARY["GLASS"], [(-50,-50),(50,-50),(50,50),(-50,50)]))
         elif type == 'lens':
-            self.scene.objects.append(CircleLens(cx, cy, MATERIALS_LIBRARY["GLASS"], 50))
+            self.scene.add(CircleLens(cx, cy, MATERIALS_LIBRARY["GLASS"], 50))
     
     def handle_input(self):
         events = pygame.event.get()
@@ -172,24 +217,17 @@ class LightLab:
                         if handle_pos.distance_to(mouse_pos) < 15:
                             self.dragging_handle = True
                         else:
-                            hit = False
-                            for obj in reversed(self.scene.objects):
-                                if obj.contains(mouse_pos):
-                                    self.selected_object = obj
-                                    self.drag_offset = obj.position - mouse_pos
-                                    obj.selected = True
-                                    hit = True
-                                    for o in self.scene.objects:
-                                        if o != obj: o.selected = False
-                                    break
-                            if not hit:
-                                self.selected_object = None
-                                for o in self.scene.objects: o.selected = False
+                            obj = self.scene.compiled().pick(mouse_pos)
+                            for o in self.scene.objects:
+                                o.selected = o is obj
+                            self.selected_object = obj
+                            if obj is not None:
+                                self.drag_offset = obj.position - mouse_pos
                 
                 elif e.button == 3:
-                    for obj in self.scene.objects:
-                        if obj.contains(mouse_pos):
-                            obj.rotation += math.radians(45)
+                    for obj in self.scene.compiled().objects_at(mouse_pos):
+                        obj.rotation += math.radians(45)
+                        self.scene.refit(obj)
             
             elif e.type == pygame.MOUSEBUTTONUP:
                 self.selected_object = None
@@ -197,6 +235,7 @@ class LightLab:
             
         if self.selected_object:
             self.selected_object.position = mouse_pos + self.drag_offset
+            self.scene.refit(self.selected_object)
         
         if self.dragging_handle:
             diff = mouse_pos - self.laser.position
@@ -207,78 +246,125 @@ class LightLab:
     def update_physics(self):
         self.particles.update()
 
+        trace_key = (self.scene.state_key(), self.laser.version)
+        if trace_key == self.trace_key:
+            return
+        self.trace_key = trace_key
 
         rays_to_cast = []
         if self.laser.wavelength == -1:
-            for i in range(10):
-                wl = 400 + (i / 9.0) * 300
-                main_dir = Vector2D.from_angle(self.laser.angle)
-                start = self.laser.position + main_dir * 50
-                perp = Vector2D(-main_dir.y, main_dir.x)
-                p = start + perp * ((i - 4.5) * 1.5)
-                rays_to_cast.append((p, main_dir, wl))
+            # One ray carries the whole spectrum until dispersion pulls it apart.
+            main_dir = Vector2D.from_angle(self.laser.angle)
+            start = self.laser.position + main_dir * 50
+            rays_to_cast.append((start, main_dir, self.white_light, 1.0))
+        elif self.laser.adaptive:
+            rays_to_cast = self.sampler.sample(self.scene, self.laser)
         else:
             rays_to_cast = self.laser.get_rays()
         
-        self.rays = self.engine.solve_scene(self.scene, rays_to_cast)
-
-
-
-    def render(self):
-        self.screen.fill(constants.BG_DARK)
+        if self.worker is not None:
+            self.worker.submit(self.scene.snapshot(), rays_to_cast)
+        else:
+            self.rays = self.tracer.solve_scene(self.scene, rays_to_cast, out=self.segments)
+
+    def trace_output(self):
+        # The latest complete trace; with a background worker the swap to a
+        # newer one waits until the caller is done reading.
+        if self.worker is not None:
+            return self.worker.reading()
+        return nullcontext(self.segments)
+
+
+
+    def draw_light(self, segs, surface):
+        self.light.clear()
+        beams = segs.beams
+        if len(beams):
+            self.light.add_quads(np.stack((beams.x1, beams.x2, beams.x3, beams.x4), axis=1),
+                                 np.stack((beams.y1, beams.y2, beams.y3, beams.y4), axis=1),
+                                 beams.intensity * (90 / 255.0), beams.colors())
+        intensity = segs.intensity
+        width = np.maximum(1.0, np.floor(intensity * 4))
+        self.light.add_segments(segs.x1, segs.y1, segs.x2, segs.y2, intensity, segs.colors(), width)
+        # Strong rays get a white-hot core.
+        core = width > 2
+        if core.any():
+            self.light.add_segments(segs.x1[core], segs.y1[core], segs.x2[core], segs.y2[core], intensity[core],
+                                    np.full((int(core.sum()), 3), 255), np.ones(int(core.sum())))
+        self.light.draw(surface, constants.LIGHT_EXPOSURE)
+
+    def paint_background(self, surface):
+        surface.fill(constants.BG_DARK)
 
         if self.scene.env_material.name == "Water":
             overlay = pygame.Surface((constants.SCREEN_WIDTH, constants.SCREEN_HEIGHT))
             overlay.fill((20, 40, 60))
             overlay.set_alpha(100)
-            self.screen.blit(overlay, (0,0))
-
+            surface.blit(overlay, (0,0))
 
         for x in range(0, constants.SCREEN_WIDTH, 50):
-            pygame.draw.line(self.screen, (20, 25, 35), (x, 0), (x, constants.SCREEN_HEIGHT))
+            pygame.draw.line(surface, (20, 25, 35), (x, 0), (x, constants.SCREEN_HEIGHT))
         for y in range(0, constants.SCREEN_HEIGHT, 50):
-            pygame.draw.line(self.screen, (20, 25, 35), (0, y), (constants.SCREEN_WIDTH, y))
-
-        self.particles.draw(self.screen, self.rays)
+            pygame.draw.line(surface, (20, 25, 35), (0, y), (constants.SCREEN_WIDTH, y))
 
+    def paint_shapes(self, surface):
         for obj in self.scene.objects:
-            obj.draw(self.screen)
-        
-        self.laser.draw(self.screen)
-
-
-        ray_surface = pygame.Surface((constants.SCREEN_WIDTH, constants.SCREEN_HEIGHT), pygame.SRCALPHA)
-        for r in self.rays:
-            start = r.p1.to_int_tuple()
-            end = r.p2.to_int_tuple()
+            obj.draw(surface)
+        self.laser.draw(surface)
 
-
-            alpha = int(r.intensity * 255)
-            if alpha < 5: continue
-
-            color = r.color + (alpha,)
-            width  = max(1, int(r.intensity * 4))
-            pygame.draw.line(ray_surface, color, start, end, width)
-            if width > 2:
-                pygame.draw.line(ray_surface, (255, 255, 255, alpha), start, end, 1)
-        
-        self.screen.blit(ray_surface, (0,0))
-
-
-        pygame.draw.rect(self.screen, constants.BG_PANEL, (constants.SCREEN_WIDTH - 300, 0, 300, constants.SCREEN_HEIGHT))
-        pygame.draw.line(self.screen, constants.BORDER, (constants.SCREEN_WIDTH - 300, 0), (constants.SCREEN_WIDTH - 300, constants.SCREEN_HEIGHT))
+    def paint_panel(self, surface, stats):
+        pygame.draw.rect(surface, constants.BG_PANEL, (constants.SCREEN_WIDTH - 300, 0, 300, constants.SCREEN_HEIGHT))
+        pygame.draw.line(surface, constants.BORDER, (constants.SCREEN_WIDTH - 300, 0), (constants.SCREEN_WIDTH - 300, constants.SCREEN_HEIGHT))
 
         for w in self.widgets:
-            w.draw(self.screen)
+            w.draw(surface)
 
+        if stats:
+            txt = self.stats_font.render(stats, True, constants.TEXT_SUB)
+            surface.blit(txt, (constants.SCREEN_WIDTH - 280, constants.SCREEN_HEIGHT - 30))
 
+    def render(self):
+        layers = self.layers
+        background = layers["background"].update(self.scene.env_material.name, self.paint_background)
+        self.screen.blit(background, (0, 0))
+
+        with self.trace_output() as segs:
+            result = self.worker.result if self.worker is not None else self.rays
+            if getattr(result, "counters", None) is not None:
+                self.trace_counters = result.counters
+            self.particles.draw(self.screen, segs)
+            rays = layers["rays"].update((id(segs), segs.version, len(segs)),
+                                         lambda surface: self.draw_light(segs, surface))
+
+        laser = self.laser
+        shapes_key = (self.scene.state_key(), laser.position.x, laser.position.y, laser.angle, laser.wavelength,
+                      laser.active, tuple(obj.selected for obj in self.scene.objects))
+        self.screen.blit(layers["shapes"].update(shapes_key, self.paint_shapes), (0, 0))
+        self.screen.blit(rays, (0, 0), special_flags=pygame.BLEND_RGB_ADD)
+
+        stats = None
+        if constants.SHOW_TRACE_STATS and self.trace_counters:
+            c = self.trace_counters
+            stats = f'{c["queries"]} rays, {c["tested"]} shape tests, {rejection_rate(c):.0%} rejected by bounds'
+        panel_key = (tuple((w.hover, getattr(w, "value", None)) for w in self.widgets), stats)
+        panel = pygame.Rect(constants.SCREEN_WIDTH - 300, 0, 300, constants.SCREEN_HEIGHT)
+        self.screen.blit(layers["panel"].update(panel_key, lambda surface: self.paint_panel(surface, stats)),
+                         panel.topleft, panel)
 
         if self.selected_object:
             if hasattr(self.selected_object, 'material'):
-                font = pygame.font.SysFont("Arial", 16)
-                txt = font.render(f'selected: {self.selected_object.material.name}', True, constants.ACCENT)
+                txt = self.info_font.render(f'selected: {self.selected_object.material.name}', True, constants.ACCENT)
                 self.screen.blit(txt, (20, constants.SCREEN_HEIGHT - 40))
 
+        if constants.SHOW_LAYER_STATS:
+            counts = ", ".join(f"{name} {layer.redraws}" for name, layer in layers.items())
+            txt = self.stats_font.render(f"redraws: {counts}", True, constants.TEXT_SUB)
+            self.screen.blit(txt, (constants.SCREEN_WIDTH - 280, constants.SCREEN_HEIGHT - 48))
+            s = SPRITES.stats()
+            txt = self.stats_font.render(f'sprites: {s["sprites"]} cached, {s["bytes"] // 1024} KB, '
+                                         f'{s["hit_rate"]:.0%} hits, {s["evictions"]} evicted', True, constants.TEXT_SUB)
+            self.screen.blit(txt, (constants.SCREEN_WIDTH - 280, constants.SCREEN_HEIGHT - 66))
+
         pygame.display.flip()
 
     def run(self):
@@ -286,8 +372,11 @@ class LightLab:
             self.update_physics()
             self.render()
             self.clock.tick(constants.FPS)
+        if self.worker is not None:
+            self.worker.stop()
         pygame.quit()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = LightLab()
     app.run()
\ No newline at end of file
@@ -5,10 +5,22 @@ class MaterialData:
         self.dispersion = dispersion
         self.opacity = opacity
         self.color = color
+        self._ior_cache = {}
     
-    def get_ior(self, wavelength):
+    def compute_ior(self, wavelength):
         wl_um = wavelength / 1000.0
         return self.ior_base + (self.dispersion / (wl_um ** 2))
+
+    def get_ior(self, wavelength):
+        # Traced wavelengths come from a handful of values (the slider, the
+        # white-light bins), so each material keeps a table of exact values
+        # keyed by wavelength and filled on first use.
+        n = self._ior_cache.get(wavelength)
+        if n is None:
+            if len(self._ior_cache) > 4096:
+                self._ior_cache.clear()
+            n = self._ior_cache[wavelength] = self.compute_ior(wavelength)
+        return n
     
 
 
@@ -1,16 +1,93 @@
-import pygame
 import math
+import copy
+import weakref
 import constants
-from utils import Vector2D, get_spectrum_color
+from utils import Vector2D
+from edgegrid import EdgeGrid
+
+def tracked(name, invalidates=False):
+    # Property that bumps the owner's version whenever it is assigned a new
+    # value; with invalidates=True it also drops cached world-space data.
+    attr = "_" + name
+
+    def get(self):
+        return getattr(self, attr)
+
+    def set(self, value):
+        old = getattr(self, attr, None)
+        if isinstance(value, Vector2D) and isinstance(old, Vector2D):
+            if old.x == value.x and old.y == value.y:
+                return
+        elif old is value or (old is not None and old == value):
+            return
+        setattr(self, attr, value)
+        if invalidates:
+            self.invalidate()
+        else:
+            self.version += 1
+
+    return property(get, set)
+
+def renderer():
+    # Drawing lives in rendering.py so that pygame is only imported once
+    # something is actually drawn; tracing never needs it.
+    import rendering
+    return rendering
 
 class Shape:
+    position = tracked("position", invalidates=True)
+    rotation = tracked("rotation", invalidates=True)
+    scale = tracked("scale", invalidates=True)
+    material = tracked("material")
+
     def __init__(self, x, y, material):
+        self.version = 0
+        self._world = None
         self.position = Vector2D(x, y)
         self.material = material
         self.rotation = 0.0
         self.selected = False
         self.scale = 1.0
 
+    def __getstate__(self):
+        # A snapshot copy's live shape stays behind; unpickled, the copy
+        # stands for itself.
+        state = dict(self.__dict__)
+        state["_world"] = None
+        state.pop("source", None)
+        return state
+
+    def invalidate(self):
+        self.version += 1
+        self._world = None
+
+    def get_world_data(self):
+        if self._world is None:
+            self._world = self.build_world_data()
+        return self._world
+
+    def build_world_data(self):
+        return {"bounds": None}
+
+    def local_frame(self):
+        # (px, py, cos, sin, 1/scale): maps world points into the shape's
+        # own frame by subtracting the position, rotating back and dividing
+        # by the scale.
+        return (self.position.x, self.position.y, math.cos(self.rotation), math.sin(self.rotation),
+                1.0 / self.scale if self.scale else 0.0)
+
+    def to_local(self, x, y):
+        px, py, ca, sa, inv_scale = self.get_world_data()["frame"]
+        rx, ry = x - px, y - py
+        return (rx * ca + ry * sa) * inv_scale, (ry * ca - rx * sa) * inv_scale
+
+    def to_world(self, x, y):
+        x *= self.scale
+        y *= self.scale
+        ca = math.cos(self.rotation)
+        sa = math.sin(self.rotation)
+        return Vector2D(self.position.x + x * ca - y * sa, self.position.y + x * sa + y * ca)
+
     def move(self, delta):
         self.position = self.position + delta
     
@@ -19,6 +96,54 @@ class Shape:
     
     def get_intersection(self, origin, direction):
         return None, None
+
+    def get_bounds(self):
+        return self.get_world_data()["bounds"]
+
+    def get_bounding_circle(self):
+        # (cx, cy, radius) enclosing the shape in world space, or None.
+        return self.get_world_data().get("circle")
+
+    def get_prefilter_circle(self):
+        # Bounding circle worth testing before get_intersection, or None when
+        # the exact test is about as cheap as the circle test itself.
+        return self.get_bounding_circle()
+
+    def is_convex(self):
+        return False
+
+    def anchor_points(self):
+        # Points such that a region whose boundary crosses none of this
+        # shape's outline overlaps the shape only if it contains one of them.
+        return []
+
+    def feature_key(self, point):
+        # Which part of the outline a surface point lies on, for telling
+        # apart rays that hit the same shape on different faces.
+        return 0
+
+    def outline_distance(self, point):
+        return float('inf')
+
+    def part_at(self, point):
+        # The simple shape a surface point belongs to; compounds override.
+        return self
+
+    def material_at(self, point):
+        return self.part_at(point).material
+
+    def world_parts(self):
+        # Simple shapes, placed in world space, that make up this one.
+        return [self]
+
+    def primitives(self):
+        # World-space outline as (arcs, segments) for CompiledScene, or None
+        # if the shape can only be hit through get_intersection. An arc is
+        # (cx, cy, r, ux, uy, cos_min, side): the points of the circle whose
+        # direction from the centre is within acos(cos_min) of (ux, uy),
+        # with outward normal side * (p - c) / r. A segment is an edge tuple
+        # as in Polygon.get_edges().
+        return None
     
     def draw(self, surface):
         pass
@@ -26,102 +151,221 @@ class Shape:
     def contains(self, point):
         return False
     
-class Polygon(Shape):
-    def __init__(self, x, y, material, vertices):
-        super().__init__(x, y, material)
-        self.local_vertices = [Vector2D(v[0], v[1]) for v in vertices]
+class PolygonGeometry:
+    # Outline in local coordinates: vertices, per-edge data (start, edge
+    # vector, unit normal, squared length) and whether it is convex. It never
+    # changes, so every polygon built from the same vertex list shares one,
+    # for as long as any polygon still holds it.
+    _shared = weakref.WeakValueDictionary()
 
-    def get_world_vertices(self):
-        verts = []
-        for v in self.local_vertices:
-            rotated = v.rotate(self.rotation)
-            scaled = rotated * self.scale
-            verts.append(self.position + scaled)
-        return verts
-    
-    def get_intersection(self, origin, direction):
-        verts = self.get_world_vertices()
-        closest_t = float('inf')
-        closest_normal = None
-        
-        count = len(verts)
+    @classmethod
+    def shared(cls, vertices):
+        key = tuple((float(v.x), float(v.y)) if isinstance(v, Vector2D) else (float(v[0]), float(v[1]))
+                    for v in vertices)
+        geometry = cls._shared.get(key)
+        if geometry is None:
+            geometry = cls._shared[key] = cls(key)
+        return geometry
+
+    def __init__(self, points):
+        self.vertices = tuple(Vector2D(x, y) for x, y in points)
+        edges = []
+        normals = []
+        count = len(self.vertices)
         for i in range(count):
-            p1 = verts[i]
-            p2 = verts[(i + 1) % count]
-            
+            p1 = self.vertices[i]
+            p2 = self.vertices[(i + 1) % count]
             edge = p2 - p1
             normal = Vector2D(edge.y, -edge.x).normalize()
-            
-            denom = normal.dot(direction)
+            edges.append((p1.x, p1.y, edge.x, edge.y, normal.x, normal.y, edge.x**2 + edge.y**2))
+            normals.append(normal)
+        self.edges = tuple(edges)
+        self.normals = tuple(normals)
+
+        turns = [edges[i][2] * edges[(i + 1) % count][3] - edges[i][3] * edges[(i + 1) % count][2] for i in range(count)]
+        self.convex = count >= 3 and (all(t >= 0 for t in turns) or all(t <= 0 for t in turns))
+        self._grid = None
+
+    def grid(self):
+        # Edge index for long outlines, built on first use.
+        if self._grid is None and len(self.edges) >= constants.EDGE_INDEX_MIN_EDGES:
+            self._grid = EdgeGrid(self.edges)
+        return self._grid
+
+    def intersect(self, ox, oy, dx, dy):
+        # Nearest edge crossing at t >= 0 as (t, edge index), or (inf, -1).
+        grid = self.grid()
+        if grid is not None:
+            return grid.intersect(ox, oy, dx, dy)
+
+        closest_t = float('inf')
+        closest_edge = -1
+        for i, (p1x, p1y, ex, ey, nx, ny, edge_len_sq) in enumerate(self.edges):
+            denom = nx * dx + ny * dy
             if abs(denom) < 1e-6: continue
-            
-            v = p1 - origin
-            t = v.dot(normal) / denom
-            
+
+            t = ((p1x - ox) * nx + (p1y - oy) * ny) / denom
             if t < 0: continue
-            
-            hit_point = origin + direction * t
-            
-            edge_len_sq = edge.x**2 + edge.y**2
-            vp = hit_point - p1
-            proj = vp.dot(edge)
-            
+
+            proj = (ox + dx * t - p1x) * ex + (oy + dy * t - p1y) * ey
             if proj >= 0 and proj <= edge_len_sq:
                 if t < closest_t:
                     closest_t = t
-                    closest_normal = normal
+                    closest_edge = i
+        return closest_t, closest_edge
 
-        if closest_t == float('inf'): return None, None
-        return closest_t, closest_normal
+    def contains(self, px, py):
+        grid = self.grid()
+        if grid is not None:
+            return grid.contains(px, py)
 
-    def contains(self, point):
-        verts = self.get_world_vertices()
+        verts = self.vertices
         inside = False
         j = len(verts) - 1
         for i in range(len(verts)):
-            if ((verts[i].y > point.y) != (verts[j].y > point.y)) and \
-               (point.x < (verts[j].x - verts[i].x) * (point.y - verts[i].y) / (verts[j].y - verts[i].y) + verts[i].x):
+            if ((verts[i].y > py) != (verts[j].y > py)) and \
+               (px < (verts[j].x - verts[i].x) * (py - verts[i].y) / (verts[j].y - verts[i].y) + verts[i].x):
                 inside = not inside
             j = i
         return inside
+
+    def __reduce__(self):
+        # Unpickles into the receiving process's shared copy.
+        return (PolygonGeometry.shared, ([(v.x, v.y) for v in self.vertices],))
+
+
+class Polygon(Shape):
+    def __init__(self, x, y, material, vertices):
+        super().__init__(x, y, material)
+        self.local_vertices = vertices
+
+    @property
+    def local_vertices(self):
+        return self.geometry.vertices
+
+    @local_vertices.setter
+    def local_vertices(self, vertices):
+        self.geometry = PolygonGeometry.shared(vertices)
+        self.invalidate()
+
+    def build_world_data(self):
+        verts = []
+        for v in self.local_vertices:
+            rotated = v.rotate(self.rotation)
+            scaled = rotated * self.scale
+            verts.append(self.position + scaled)
+
+        # Per edge: the shared outline's, rotated and scaled into place.
+        ca, sa, scale = math.cos(self.rotation), math.sin(self.rotation), self.scale
+        edges = [(p.x, p.y, (ex * ca - ey * sa) * scale, (ex * sa + ey * ca) * scale,
+                  nx * ca - ny * sa, nx * sa + ny * ca, edge_len_sq * scale * scale)
+                 for p, (_, _, ex, ey, nx, ny, edge_len_sq) in zip(verts, self.geometry.edges)]
+
+        bounds = None
+        circle = None
+        if verts:
+            bounds = (min(v.x for v in verts), min(v.y for v in verts),
+                      max(v.x for v in verts), max(v.y for v in verts))
+            cx = (bounds[0] + bounds[2]) * 0.5
+            cy = (bounds[1] + bounds[3]) * 0.5
+            circle = (cx, cy, max(math.hypot(v.x - cx, v.y - cy) for v in verts))
+
+        return {
+            "vertices": verts,
+            "edges": edges,
+            "bounds": bounds,
+            "circle": circle,
+            "frame": self.local_frame(),
+            "points": [v.to_int_tuple() for v in verts],
+        }
+
+    def get_world_vertices(self):
+        return self.get_world_data()["vertices"]
+
+    def get_edges(self):
+        return self.get_world_data()["edges"]
+
+    def primitives(self):
+        return (), self.get_edges()
     
-    def draw(self, surface):
-        verts = self.get_world_vertices()
-        points = [v.to_int_tuple() for v in verts]
-        
-        if not points: return
+    def get_intersection(self, origin, direction):
+        # The ray is taken into the local frame once and tested against the
+        # shared outline. The map is affine, so t is the same in both frames.
+        px, py, ca, sa, inv_scale = self.get_world_data()["frame"]
+        rx, ry = origin.x - px, origin.y - py
+        ox = (rx * ca + ry * sa) * inv_scale
+        oy = (ry * ca - rx * sa) * inv_scale
+        dx = (direction.x * ca + direction.y * sa) * inv_scale
+        dy = (direction.y * ca - direction.x * sa) * inv_scale
+        closest_t, closest_edge = self.geometry.intersect(ox, oy, dx, dy)
 
-        min_x = min(p[0] for p in points)
-        max_x = max(p[0] for p in points)
-        min_y = min(p[1] for p in points)
-        max_y = max(p[1] for p in points)
-        
-        w = max_x - min_x + 4
-        h = max_y - min_y + 4
-        
-        if w > 0 and h > 0:
-            s = pygame.Surface((w, h), pygame.SRCALPHA)
-            offset_points = [(p[0] - min_x + 2, p[1] - min_y + 2) for p in points]
-            pygame.draw.polygon(s, self.material.color, offset_points)
-            surface.blit(s, (min_x - 2, min_y - 2))
-            
-        color = constants.ACCENT if self.selected else (100, 120, 140)
-        pygame.draw.polygon(surface, color, points, 2)
-        
-        if self.selected:
-            for p in points:
-                pygame.draw.circle(surface, constants.SUCCESS, p, 3)
+        if closest_edge < 0: return None, None
+        n = self.geometry.normals[closest_edge]
+        if self.scale < 0:
+            n = -n
+        return closest_t, Vector2D(n.x * ca - n.y * sa, n.x * sa + n.y * ca)
+
+    def is_convex(self):
+        return self.geometry.convex
+
+    def get_prefilter_circle(self):
+        if len(self.local_vertices) < constants.PREFILTER_MIN_EDGES:
+            return None
+        return self.get_bounding_circle()
+
+    def anchor_points(self):
+        return self.get_world_vertices()
+
+    def feature_key(self, point):
+        best = 0
+        best_dist = float('inf')
+        for i, (p1x, p1y, ex, ey, nx, ny, edge_len_sq) in enumerate(self.get_edges()):
+            dist = abs((point.x - p1x) * nx + (point.y - p1y) * ny)
+            if dist < best_dist:
+                best = i
+                best_dist = dist
+        return best
+
+    def outline_distance(self, point):
+        best = float('inf')
+        for p1x, p1y, ex, ey, nx, ny, edge_len_sq in self.get_edges():
+            u = ((point.x - p1x) * ex + (point.y - p1y) * ey) / edge_len_sq if edge_len_sq else 0.0
+            u = min(1.0, max(0.0, u))
+            best = min(best, math.hypot(point.x - p1x - ex * u, point.y - p1y - ey * u))
+        return best
+
+    def contains(self, point):
+        if not self.scale:
+            return False
+        return self.geometry.contains(*self.to_local(point.x, point.y))
+
+    def draw(self, surface):
+        renderer().draw_polygon(self, surface)
 
 class CircleLens(Shape):
     def __init__(self, x, y, material, radius):
         super().__init__(x, y, material)
         self.radius = float(radius)
 
+    @property
+    def radius(self):
+        return self._radius
+
+    @radius.setter
+    def radius(self, value):
+        self._radius = value
+        self.invalidate()
+
+    def world_radius(self):
+        # The radius as scaled, e.g. when the lens is part of a compound.
+        return self.get_world_data()["radius"]
+
     def get_intersection(self, origin, direction):
         oc = origin - self.position
+        r = self.world_radius()
         a = direction.dot(direction)
         b = 2.0 * oc.dot(direction)
-        c = oc.dot(oc) - self.radius * self.radius
+        c = oc.dot(oc) - r * r
         discriminant = b*b - 4*a*c
         
         if discriminant < 0: return None, None
@@ -139,26 +383,323 @@ class CircleLens(Shape):
         normal = (hit_point - self.position).normalize()
         return t, normal
 
+    def build_world_data(self):
+        r = self.radius * self.scale
+        return {
+            "radius": r,
+            "bounds": (self.position.x - r, self.position.y - r, self.position.x + r, self.position.y + r),
+            "circle": (self.position.x, self.position.y, r),
+        }
+
+    def is_convex(self):
+        return True
+
+    def get_prefilter_circle(self):
+        return None
+
+    def primitives(self):
+        return ((self.position.x, self.position.y, self.world_radius(), 1.0, 0.0, -2.0, 1.0),), ()
+
+    def anchor_points(self):
+        return [self.position]
+
+    def outline_distance(self, point):
+        return abs(point.distance_to(self.position) - self.world_radius())
+
     def contains(self, point):
-        return point.distance_to(self.position) < self.radius
+        return point.distance_to(self.position) < self.world_radius()
 
     def draw(self, surface):
-        r = int(self.radius)
-        x = int(self.position.x)
-        y = int(self.position.y)
-        
-        s = pygame.Surface((r*2, r*2), pygame.SRCALPHA)
-        pygame.draw.circle(s, self.material.color, (r, r), r)
-        surface.blit(s, (x - r, y - r))
-        
-        color = constants.ACCENT if self.selected else (100, 120, 140)
-        pygame.draw.circle(surface, color, (x, y), r, 2)
+        renderer().draw_circle_lens(self, surface)
+
+def surface_x(vertex_x, radius, y):
+    # x of a lens surface at height y; radius 0 means flat.
+    if not radius:
+        return vertex_x
+    return vertex_x + radius - math.copysign(math.sqrt(radius * radius - y * y), radius)
+
+def segment_distance(px, py, ax, ay, bx, by):
+    ex, ey = bx - ax, by - ay
+    len_sq = ex * ex + ey * ey
+    u = min(1.0, max(0.0, ((px - ax) * ex + (py - ay) * ey) / len_sq)) if len_sq else 0.0
+    return math.hypot(px - ax - ex * u, py - ay - ey * u)
+
+class ThickLens(Shape):
+    # Lens with two spherical (or flat) faces joined by flat rims, facing
+    # along its local x axis. Radii follow the usual sign convention: r1 > 0
+    # bulges the front face towards -x, r2 < 0 bulges the back face towards
+    # +x, and 0 makes a face flat. `thickness` is measured on the axis and
+    # `aperture` is the full height. Faces are intersected exactly.
+    r1 = tracked("r1", invalidates=True)
+    r2 = tracked("r2", invalidates=True)
+    thickness = tracked("thickness", invalidates=True)
+    aperture = tracked("aperture", invalidates=True)
+
+    def __init__(self, x, y, material, r1, r2, thickness, aperture):
+        half = aperture / 2.0
+        if (r1 and abs(r1) < half) or (r2 and abs(r2) < half):
+            raise ValueError("lens radius is smaller than half the aperture")
+        if surface_x(-thickness / 2.0, r1, half) > surface_x(thickness / 2.0, r2, half):
+            raise ValueError("lens faces cross inside the aperture")
+        super().__init__(x, y, material)
+        self.r1 = float(r1)
+        self.r2 = float(r2)
+        self.thickness = float(thickness)
+        self.aperture = float(aperture)
+
+    def build_world_data(self):
+        half = self.aperture / 2.0
+        front_x = -self.thickness / 2.0
+        back_x = self.thickness / 2.0
+        # Where each face meets the rims.
+        front_rim = surface_x(front_x, self.r1, half)
+        back_rim = surface_x(back_x, self.r2, half)
+
+        corners = [self.to_world(x, y) for x in (min(front_x, front_rim), max(back_x, back_rim)) for y in (-half, half)]
+        bounds = (min(p.x for p in corners), min(p.y for p in corners),
+                  max(p.x for p in corners), max(p.y for p in corners))
+        center = (corners[0] + corners[3]) * 0.5
+
+        steps = 24
+        outline = [(surface_x(front_x, self.r1, y), y) for y in (half * (2.0 * k / steps - 1) for k in range(steps + 1))]
+        outline += [(surface_x(back_x, self.r2, y), y) for y in (half * (1 - 2.0 * k / steps) for k in range(steps + 1))]
+
+        return {
+            # Per face: vertex x, radius, and the x sign of its outward normal.
+            "faces": ((front_x, self.r1, -1.0), (back_x, self.r2, 1.0)),
+            "rims": (front_rim, back_rim),
+            "bounds": bounds,
+            "circle": (center.x, center.y, corners[0].distance_to(corners[3]) * 0.5),
+            "frame": self.local_frame(),
+            "anchors": [self.to_world(x, y) for x in (front_rim, back_rim) for y in (-half, half)]
+                       + [self.to_world(front_x, 0.0), self.to_world(back_x, 0.0)],
+            "points": [self.to_world(x, y).to_int_tuple() for x, y in outline],
+        }
+
+    def get_intersection(self, origin, direction):
+        world = self.get_world_data()
+        px, py, ca, sa, inv_scale = world["frame"]
+        rx, ry = origin.x - px, origin.y - py
+        ox = (rx * ca + ry * sa) * inv_scale
+        oy = (ry * ca - rx * sa) * inv_scale
+        dx = (direction.x * ca + direction.y * sa) * inv_scale
+        dy = (direction.y * ca - direction.x * sa) * inv_scale
+        half = self.aperture / 2.0
+
+        closest_t = float('inf')
+        nx = ny = 0.0
+        for vertex_x, radius, side in world["faces"]:
+            if not radius:
+                if dx == 0: continue
+                t = (vertex_x - ox) / dx
+                if t > 0.001 and t < closest_t and abs(oy + dy * t) <= half:
+                    closest_t, nx, ny = t, side, 0.0
+                continue
+
+            qx = ox - vertex_x - radius
+            a = dx * dx + dy * dy
+            b = qx * dx + oy * dy
+            disc = b * b - a * (qx * qx + oy * oy - radius * radius)
+            if disc < 0: continue
+            root = math.sqrt(disc)
+            for t in ((-b - root) / a, (-b + root) / a):
+                if t > 0.001 and t < closest_t:
+                    hx = qx + dx * t
+                    hy = oy + dy * t
+                    # Only the cap of the sphere facing away from its centre
+                    # and within the aperture belongs to the lens.
+                    if abs(hy) <= half and hx * radius <= 0:
+                        closest_t, nx, ny = t, -side * hx / radius, -side * hy / radius
+
+        if dy != 0:
+            front_rim, back_rim = world["rims"]
+            for rim_y in (half, -half):
+                t = (rim_y - oy) / dy
+                if t > 0.001 and t < closest_t and front_rim <= ox + dx * t <= back_rim:
+                    closest_t, nx, ny = t, 0.0, math.copysign(1.0, rim_y)
+
+        if closest_t == float('inf'): return None, None
+        if self.scale < 0:
+            nx, ny = -nx, -ny
+        return closest_t, Vector2D(nx * ca - ny * sa, nx * sa + ny * ca)
+
+    def face_distances(self, point):
+        # Local-space distance from a point to the front face, back face,
+        # top rim and bottom rim.
+        world = self.get_world_data()
+        x, y = self.to_local(point.x, point.y)
+        half = self.aperture / 2.0
+        distances = []
+        for (vertex_x, radius, side), rim_x in zip(world["faces"], world["rims"]):
+            if not radius:
+                distances.append(segment_distance(x, y, vertex_x, -half, vertex_x, half))
+                continue
+            cx = vertex_x + radius
+            length = math.hypot(x - cx, y)
+            qx = cx + (x - cx) * abs(radius) / length if length else cx - radius
+            qy = y * abs(radius) / length if length else 0.0
+            if abs(qy) <= half and (qx - cx) * radius <= 0:
+                distances.append(math.hypot(x - qx, y - qy))
+            else:
+                distances.append(min(math.hypot(x - rim_x, y - half), math.hypot(x - rim_x, y + half)))
+        front_rim, back_rim = world["rims"]
+        for rim_y in (-half, half):
+            distances.append(segment_distance(x, y, front_rim, rim_y, back_rim, rim_y))
+        return distances
+
+    def feature_key(self, point):
+        distances = self.face_distances(point)
+        return distances.index(min(distances))
+
+    def outline_distance(self, point):
+        return min(self.face_distances(point)) * abs(self.scale)
+
+    def is_convex(self):
+        return self.r1 >= 0 and self.r2 <= 0
+
+    def primitives(self):
+        world = self.get_world_data()
+        half = self.aperture / 2.0
+        ca = math.cos(self.rotation)
+        sa = math.sin(self.rotation)
+        flip = math.copysign(1.0, self.scale)
+
+        def segment(ax, ay, bx, by, nx, ny):
+            a = self.to_world(ax, ay)
+            edge = self.to_world(bx, by) - a
+            nx, ny = nx * flip, ny * flip
+            return (a.x, a.y, edge.x, edge.y, nx * ca - ny * sa, nx * sa + ny * ca, edge.x**2 + edge.y**2)
+
+        arcs = []
+        segments = []
+        for vertex_x, radius, side in world["faces"]:
+            if not radius:
+                segments.append(segment(vertex_x, -half, vertex_x, half, side, 0.0))
+                continue
+            center = self.to_world(vertex_x + radius, 0.0)
+            # From the centre the face's vertex lies towards -radius.
+            toward = -math.copysign(1.0, radius) * flip
+            ux, uy = toward * ca, toward * sa
+            cos_min = math.sqrt(max(0.0, radius * radius - half * half)) / abs(radius)
+            arcs.append((center.x, center.y, abs(radius * self.scale), ux, uy, cos_min, -side * math.copysign(1.0, radius)))
+        front_rim, back_rim = world["rims"]
+        for rim_y in (half, -half):
+            segments.append(segment(front_rim, rim_y, back_rim, rim_y, 0.0, math.copysign(1.0, rim_y)))
+        return arcs, segments
+
+    def anchor_points(self):
+        return self.get_world_data()["anchors"]
+
+    def contains(self, point):
+        if not self.scale:
+            return False
+        x, y = self.to_local(point.x, point.y)
+        half = self.aperture / 2.0
+        if abs(y) > half:
+            return False
+        return surface_x(-self.thickness / 2.0, self.r1, y) <= x <= surface_x(self.thickness / 2.0, self.r2, y)
+
+    def draw(self, surface):
+        renderer().draw_thick_lens(self, surface)
+
+class CompoundShape(Shape):
+    # Several shapes placed, rotated and hit-tested as one, e.g. a lens
+    # assembly. Parts are given relative to the compound's position and are
+    # owned by it afterwards. The world-space copies are shallow, so every
+    # polygon part keeps sharing its PolygonGeometry.
+    def __init__(self, x, y, parts):
+        self.parts = tuple(parts)
+        super().__init__(x, y, self.parts[0].material)
+
+    @property
+    def material(self):
+        return self.parts[0].material
+
+    @material.setter
+    def material(self, material):
+        if material is self.material:
+            return
+        # New parts rather than edited ones, so snapshots keep the old.
+        parts = [copy.copy(part) for part in self.parts]
+        for part in parts:
+            part.material = material
+        self.parts = tuple(parts)
+        self.invalidate()
+
+    def build_world_data(self):
+        ca = math.cos(self.rotation)
+        sa = math.sin(self.rotation)
+        parts = []
+        for part in self.parts:
+            placed = copy.copy(part)
+            offset = part.position * self.scale
+            placed.position = Vector2D(self.position.x + offset.x * ca - offset.y * sa,
+                                       self.position.y + offset.x * sa + offset.y * ca)
+            placed.rotation = self.rotation + part.rotation
+            placed.scale = self.scale * part.scale
+            parts.append(placed)
+
+        boxes = [part.get_bounds() for part in parts]
+        bounds = None
+        circle = None
+        if boxes and None not in boxes:
+            bounds = (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                      max(b[2] for b in boxes), max(b[3] for b in boxes))
+            cx = (bounds[0] + bounds[2]) * 0.5
+            cy = (bounds[1] + bounds[3]) * 0.5
+            circle = (cx, cy, max(math.hypot(c[0] - cx, c[1] - cy) + c[2]
+                                  for c in (part.get_bounding_circle() for part in parts)))
+
+        return {"parts": parts, "bounds": bounds, "circle": circle}
+
+    def world_parts(self):
+        return self.get_world_data()["parts"]
+
+    def get_intersection(self, origin, direction):
+        closest_t = None
+        closest_normal = None
+        for part in self.world_parts():
+            t, normal = part.get_intersection(origin, direction)
+            if t is not None and (closest_t is None or t < closest_t):
+                closest_t = t
+                closest_normal = normal
+        return closest_t, closest_normal
+
+    def part_at(self, point):
+        return min(self.world_parts(), key=lambda part: part.outline_distance(point))
+
+    def feature_key(self, point):
+        parts = self.world_parts()
+        part = self.part_at(point)
+        return (parts.index(part), part.feature_key(point))
+
+    def outline_distance(self, point):
+        return min(part.outline_distance(point) for part in self.world_parts())
+
+    def anchor_points(self):
+        return [p for part in self.world_parts() for p in part.anchor_points()]
+
+    def contains(self, point):
+        return any(part.contains(point) for part in self.world_parts())
+
+    def draw(self, surface):
+        renderer().draw_compound(self, surface)
 
 class LaserSource:
+    position = tracked("position")
+    angle = tracked("angle")
+    active = tracked("active")
+    adaptive = tracked("adaptive")
+    wavelength = tracked("wavelength")
+    beam_count = tracked("beam_count")
+    spread = tracked("spread")
+
     def __init__(self, x, y):
+        self.version = 0
         self.position = Vector2D(x, y)
         self.angle = 0.0
         self.active = True
+        self.adaptive = False
         self.wavelength = 650
         self.beam_count = 1
         self.spread = 0.0
@@ -172,7 +713,7 @@ class LaserSource:
         start = self.position + main_dir * 50
         
         if self.beam_count == 1:
-            rays.append((start, main_dir, self.wavelength))
+            rays.append((start, main_dir, self.wavelength, 1.0))
         else:
             for i in range(self.beam_count):
                 offset_idx = i - (self.beam_count -1) / 2.0
@@ -180,30 +721,15 @@ class LaserSource:
                 if self.spread > 0:
                     angle_offset = math.radians(offset_idx * self.spread)
                     d = main_dir.rotate(angle_offset)
-                    rays.append((start, d, self.wavelength))
+                    rays.append((start, d, self.wavelength, 1.0))
                 else:
                     p = start + perp * (offset_idx * 3)
-                    rays.append((p, main_dir, self.wavelength))
+                    rays.append((p, main_dir, self.wavelength, 1.0))
 
         return rays
     
     def draw(self, surface):
-        pos = self.position.to_int_tuple()
-
-        s= pygame.Surface((100, 50,), pygame.SRCALPHA)
-        pygame.draw.rect(s, (60, 70, 80), (0, 10, 80, 30), border_radius=4)
-        pygame.draw.rect(s, (40, 50, 60), (10, 15, 60, 20))
-
-        color = get_spectrum_color(self.wavelength) if self.active else (50, 20, 20)
-        pygame.draw.circle(s, color, (15, 25), 5)
-
-        rotated = pygame.transform.rotate(s, -math.degrees(self.angle))
-        rect = rotated.get_rect(center=pos)
-        surface.blit(rotated, rect)
-
-
-        handle = self.position - Vector2D.from_angle(self.angle) * 60
-        pygame.draw.circle(surface, constants.LASER_HANDLE, handle.to_int_tuple(), 6)
+        renderer().draw_laser(self, surface)
 
     def contains(self, point):
         return self.position.distance_to(point) < 40
\ No newline at end of file
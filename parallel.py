@@ -0,0 +1,154 @@
+import atexit
+import multiprocessing
+import pickle
+import queue
+import numpy as np
+from multiprocessing import shared_memory
+
+import constants
+from utils import Vector2D
+from buffers import SegmentBuffer
+from physics import PhysicsEngine, TraceResult
+
+
+def worker_main(engine_class, shm_name, capacity, tasks, results, worker_id):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    rows = np.ndarray((capacity,), dtype=SegmentBuffer.DTYPE, buffer=shm.buf)
+    engine = engine_class()
+    buffer = SegmentBuffer()
+    scene = None
+    try:
+        while True:
+            message = tasks.get()
+            if message is None:
+                break
+            if message[0] == "scene":
+                scene = pickle.loads(message[1])
+                continue
+
+            _, job, rays, budget = message
+            engine.segment_budget = min(budget, capacity)
+            ray_origins = [(Vector2D(ox, oy), Vector2D(dx, dy), wl, i) for ox, oy, dx, dy, wl, i in rays]
+            result = engine.solve_scene(scene, ray_origins, out=buffer)
+            n = len(buffer)
+            for name, _ in SegmentBuffer.FIELDS:
+                rows[name][:n] = buffer.arrays[name][:n]
+            results.put((worker_id, job, n, result.culled_branches))
+    finally:
+        del rows
+        shm.close()
+
+
+class ParallelEngine:
+    # Splits the source rays across long-lived worker processes. Each worker
+    # holds its own copy of the scene, refreshed only when the scene's state
+    # key changes, and writes its segments into a shared-memory block that
+    # the main process reads without unpickling anything.
+    def __init__(self, engine_class=PhysicsEngine, workers=None, min_rays=None, segment_budget=None):
+        self.engine_class = engine_class
+        self.local = engine_class()
+        self.segment_budget = constants.SEGMENT_BUDGET if segment_budget is None else segment_budget
+        self.epsilon = self.local.epsilon
+        self.should_stop = None
+        self.worker_count = workers or max(1, min(constants.PARALLEL_WORKERS, multiprocessing.cpu_count()))
+        self.min_rays = constants.PARALLEL_MIN_RAYS if min_rays is None else min_rays
+        self.workers = []
+        self.capacity = 0
+        self.scene_key = None
+        self.job = 0
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        # Sized for the default budget rather than the current one, which
+        # IncrementalTracer lowers while it retraces part of a frame.
+        capacity = self.capacity = max(self.segment_budget, constants.SEGMENT_BUDGET)
+        for worker_id in range(self.worker_count):
+            shm = shared_memory.SharedMemory(create=True, size=capacity * SegmentBuffer.DTYPE.itemsize)
+            tasks = context.Queue()
+            process = context.Process(target=worker_main, daemon=True,
+                                      args=(self.engine_class, shm.name, capacity, tasks, self.results, worker_id))
+            process.start()
+            rows = np.ndarray((capacity,), dtype=SegmentBuffer.DTYPE, buffer=shm.buf)
+            self.workers.append((process, tasks, shm, rows))
+        atexit.unregister(self.close)
+        atexit.register(self.close)
+
+    def close(self):
+        workers, self.workers = self.workers, []
+        for process, tasks, shm, rows in workers:
+            tasks.put(None)
+        for process, tasks, shm, rows in workers:
+            process.join(timeout=1.0)
+            if process.is_alive():
+                process.terminate()
+        # The NumPy views must go before the blocks can be closed.
+        blocks = [shm for process, tasks, shm, rows in workers]
+        workers = None
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+        self.scene_key = None
+
+    def solve_locally(self, scene, ray_origins, out):
+        self.local.segment_budget = self.segment_budget
+        self.local.should_stop = self.should_stop
+        return self.local.solve_scene(scene, ray_origins, out=out)
+
+    def solve_scene(self, scene, ray_origins, out=None):
+        if out is None or len(ray_origins) < self.min_rays:
+            return self.solve_locally(scene, ray_origins, out)
+
+        if self.workers and self.segment_budget > self.capacity:
+            self.close()
+        if not self.workers:
+            self.start()
+
+        scene_key = scene.state_key()
+        if scene_key != self.scene_key:
+            snapshot = pickle.dumps(scene)
+            for process, tasks, shm, rows in self.workers:
+                tasks.put(("scene", snapshot))
+            self.scene_key = scene_key
+
+        self.job += 1
+        chunks = np.array_split(np.arange(len(ray_origins)), len(self.workers))
+        pending = 0
+        for (process, tasks, shm, rows), chunk in zip(self.workers, chunks):
+            if len(chunk) == 0:
+                continue
+            rays = [(o.x, o.y, d.x, d.y, wl, i) for o, d, wl, i in (ray_origins[i] for i in chunk)]
+            budget = max(1, self.segment_budget * len(chunk) // len(ray_origins))
+            tasks.put(("trace", self.job, rays, budget))
+            pending += 1
+
+        done = {}
+        while len(done) < pending:
+            try:
+                worker_id, job, count, culled = self.results.get(timeout=0.05)
+            except queue.Empty:
+                if self.should_stop is not None and self.should_stop():
+                    # Late replies carry this job number and are ignored.
+                    return TraceResult(out, 0, cancelled=True)
+                if all(process.is_alive() for process, tasks, shm, rows in self.workers):
+                    continue
+                # A worker died; shut the pool down and trace in-process.
+                self.close()
+                return self.solve_locally(scene, ray_origins, out)
+            if job == self.job:
+                done[worker_id] = (count, culled)
+
+        out.clear()
+        culled = 0
+        for worker_id in sorted(done):
+            count, worker_culled = done[worker_id]
+            rows = self.workers[worker_id][3][:count]
+            columns = {name: rows[name] for name, _ in SegmentBuffer.FIELDS}
+            # Roots name their source ray by its index within the chunk.
+            parent = rows["parent"] + out.count
+            roots = rows["parent"] < 0
+            parent[roots] = -1 - chunks[worker_id][-1 - rows["parent"][roots]]
+            columns["parent"] = parent
+            out.extend(**columns)
+            culled += worker_culled
+        return TraceResult(out, culled)
@@ -1,14 +1,19 @@
 import math 
-import pygame
+import heapq
+import itertools
 import constants
-from utils import Vector2D, get_spectrum_color
+from utils import Vector2D, Spectrum, get_spectrum_color
+from buffers import SegmentBuffer, pack_color
 
 class RayHit:
-    def __init__(self, t, point, normal, obj):
+    def __init__(self, t, point, normal, obj, material=None):
         self.t = t
         self.point = point
         self.normal = normal
         self.obj = obj
+        # Material of the part that was hit; differs from obj.material only
+        # on compound shapes.
+        self.material = obj.material if material is None and obj != "WALL" else material
 
 class RaySegment:
     def __init__(self, p1, p2, intensity, wavelength, color):
@@ -18,92 +23,227 @@ class RaySegment:
         self.wavelength = wavelength
         self.color = color
 
+class TraceResult:
+    def __init__(self, segments, culled_branches=0, cancelled=False, counters=None):
+        self.segments = segments
+        self.culled_branches = culled_branches
+        self.cancelled = cancelled
+        # Intersection counters from the scene's BVH, when the engine used one.
+        self.counters = counters
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __len__(self):
+        return len(self.segments)
+
 class PhysicsEngine:
-    def __init__(self):
+    def __init__(self, segment_budget=None):
         self.epsilon = 0.001
+        self.segment_budget = constants.SEGMENT_BUDGET if segment_budget is None else segment_budget
+        # Optional callable polled while tracing; returning True abandons the
+        # trace and marks the result as cancelled.
+        self.should_stop = None
+        self.enclosing = set()
+
+    def solve_scene(self, scene, ray_origins, out=None):
+        # Branches wait in a max-heap on intensity, so when the budget runs
+        # out the ones left behind are always the dimmest. Segments go into
+        # `out` when a SegmentBuffer is supplied, else into RaySegment objects.
+        if out is None:
+            all_segments = []
+        else:
+            all_segments = out
+            all_segments.clear()
+        self.object_index = {id(obj): i for i, obj in enumerate(scene.objects)}
+        self.enclosing = self.enclosing_shapes(scene)
+        bvh = scene.get_bvh()
+        bvh.reset_counters()
+        queue = []
+        order = itertools.count()
+        for i, (origin, direction, wavelength, intensity) in enumerate(ray_origins):
+            self.push_branch(queue, order, origin, direction, wavelength, intensity, scene.env_material, 0, -1 - i, None)
+
+        culled = 0
+        traced = 0
+        while queue:
+            if len(all_segments) >= self.segment_budget:
+                culled = len(queue)
+                break
+            traced += 1
+            if self.should_stop is not None and traced % 64 == 0 and self.should_stop():
+                return TraceResult(all_segments, len(queue), cancelled=True)
+            branch = heapq.heappop(queue)[2]
+            for child in self.cast_ray(scene, *branch, all_segments):
+                self.push_branch(queue, order, *child)
 
-    def solve_scene(self, scene, ray_origins):
-        all_segments = []
-        for origin, direction, wavelength in ray_origins:
-            self.cast_ray(scene, origin, direction, wavelength, 1.0, scene.env_material, 0, all_segments)
-        return all_segments
-    
-    def cast_ray(self, scene, origin, direction, wavelength, intensity, current_medium, depth, output_list):
+        return TraceResult(all_segments, culled, counters=dict(bvh.counters))
+
+    def push_branch(self, queue, order, origin, direction, wavelength, intensity, current_medium, depth, parent, inside):
         if depth > constants.MAX_RECURSION or intensity < constants.MIN_INTENSITY:
             return
-        
-        hit = self.find_closest_intersection(scene, origin, direction)
+        heapq.heappush(queue, (-intensity, next(order), (origin, direction, wavelength, intensity, current_medium, depth, parent, inside)))
+
+    def enclosing_shapes(self, scene):
+        # Ids of shapes a ray can be resolved against on its own once inside:
+        # convex, clear of every other shape's bounds and of the screen edge.
+        # Anything else, overlapping shapes included, takes the general path.
+        enclosing = set()
+        if not constants.CONVEX_FAST_PATH:
+            return enclosing
+        isolated = scene.isolated_shapes()
+        for obj in scene.objects:
+            if id(obj) not in isolated:
+                continue
+            bounds = obj.get_bounds()
+            if bounds[0] > 0 and bounds[1] > 0 and bounds[2] < constants.SCREEN_WIDTH and bounds[3] < constants.SCREEN_HEIGHT:
+                enclosing.add(id(obj))
+        return enclosing
+
+    def emit(self, output, p1, p2, intensity, wavelength, depth, parent, hit_obj=None):
+        if isinstance(wavelength, Spectrum):
+            # A bundle is recorded under its hero wavelength in its blended colour.
+            color = wavelength.color
+            wavelength = wavelength.hero
+        else:
+            color = get_spectrum_color(wavelength)
+        if isinstance(output, SegmentBuffer):
+            hit = self.object_index.get(id(hit_obj), -1) if hit_obj is not None else -1
+            return output.append(p1.x, p1.y, p2.x, p2.y, intensity, wavelength, pack_color(color), depth, parent, hit)
+        output.append(RaySegment(p1, p2, intensity, wavelength, color))
+        return len(output) - 1
+
+    def cast_ray(self, scene, origin, direction, wavelength, intensity, current_medium, depth, parent, inside, output):
+        # Emits the segment for one branch and returns its child branches.
+        # `inside` is the enclosing shape the branch is travelling through,
+        # if any; its exit is then found without searching the scene.
+        hit = None
+        if inside is not None:
+            t, normal = inside.get_intersection(origin, direction)
+            if t is not None and t > self.epsilon:
+                hit = RayHit(t, origin + direction * t, normal, inside)
+        if hit is None:
+            hit = self.find_closest_intersection(scene, origin, direction)
 
         if hit  is None:
             end_point = origin + direction * constants.RAY_STEP
-            output_list.append(RaySegment(origin, end_point, intensity, wavelength, get_spectrum_color(wavelength)))
-            return
+            self.emit(output, origin, end_point, intensity, wavelength, depth, parent)
+            return ()
 
         dist = hit.point.distance_to(origin)
         transmission_loss = math.exp(-current_medium.opacity * (dist / 100.0))
         final_intensity = intensity * transmission_loss
 
-        output_list.append(RaySegment(origin, hit.point, final_intensity, wavelength, get_spectrum_color(wavelength)))
+        index = self.emit(output, origin, hit.point, final_intensity, wavelength, depth, parent, hit.obj)
 
         if hit.obj == "WALL":
-            return
-        
-        is_entering = direction.dot(hit.normal) < 0
+            return ()
 
-        n1 = current_medium.get_ior(wavelength)
-        n2 = hit.obj.material.get_ior(wavelength)
+        return self.scatter(scene, hit, direction, wavelength, final_intensity, current_medium, depth, index, inside)
 
-        normal = hit.normal
+    def scatter(self, scene, hit, direction, wavelength, final_intensity, current_medium, depth, index, inside=None):
+        # Child branches leaving a shape surface; `index` is the parent segment.
+        # Reflected branches stay wherever the incoming one was; refracted
+        # ones are inside the hit shape after entering it, outside after not.
+        is_entering = direction.dot(hit.normal) < 0
+        refracted_inside = hit.obj if is_entering and id(hit.obj) in self.enclosing else None
 
-        if not is_entering:
-            n1 = hit.obj.material.get_ior(wavelength)
-            n2 = scene.env_material.get_ior(wavelength)
+        if is_entering:
+            from_material = current_medium
+            to_material = hit.material
+            normal = hit.normal
+        else:
+            from_material = hit.material
+            to_material = scene.env_material
             normal = -hit.normal
-        
-        ratio = n1 / n2
-        cos_i = -normal.dot(direction)
-        sin_t2 = ratio * ratio * (1.0 - cos_i * cos_i)
-
-        reflectivity = 1.0
-        is_tir = True
 
-        if sin_t2 <= 1.0:
-            is_tir = False
-            cos_t = math.sqrt(1.0 - sin_t2)
+        bundle = wavelength if isinstance(wavelength, Spectrum) else None
+        hero = wavelength if bundle is None else bundle.hero
+        n1 = from_material.get_ior(hero)
+        n2 = to_material.get_ior(hero)
+        cos_i = -normal.dot(direction)
+        reflectivity, cos_t = self.fresnel(n1, n2, cos_i)
 
-            r_orth = (n1 * cos_i - n2 * cos_t) / (n1 * cos_i + n2 * cos_t)
-            r_par = (n2 * cos_i - n1 * cos_t) / (n2 * cos_i + n1 * cos_t)
-            reflectivity = (r_orth * r_orth + r_par * r_par) / 2.0
-        
+        children = []
+        # Reflection does not depend on wavelength, so a bundle stays whole.
         reflect_dir = direction.reflect(normal).normalize()
         reflect_start = hit.point + reflect_dir * self.epsilon
 
         if reflectivity > 0.05:
-            self.cast_ray(scene, reflect_start, reflect_dir, wavelength, final_intensity * reflectivity, current_medium, depth + 1, output_list)
-        
-        if not is_tir:
+            children.append((reflect_start, reflect_dir, wavelength, final_intensity * reflectivity, current_medium, depth + 1, index, inside))
+
+        if bundle is not None:
+            children.extend(self.refract_bundle(bundle, hit.point, direction, normal, cos_i, from_material,
+                                                to_material, final_intensity, depth, index, refracted_inside))
+        elif cos_t is not None:
             transmission_ratio = 1.0 - reflectivity
             if transmission_ratio > 0.05:
-                k = 1.0 - ratio * ratio * (1.0 - cos_i * cos_i)
-                refract_dir = (direction * ratio + normal * (ratio * cos_i - math.sqrt(k))).normalize()
+                refract_dir = self.refract(direction, normal, n1 / n2, cos_i, cos_t)
                 refract_start = hit.point + refract_dir * self.epsilon
+                children.append((refract_start, refract_dir, wavelength, final_intensity * transmission_ratio, to_material, depth + 1, index, refracted_inside))
 
-                new_medium = hit.obj.material if is_entering else scene.env_material
-                self.cast_ray(scene, refract_start, refract_dir, wavelength, final_intensity * transmission_ratio, new_medium, depth + 1, output_list)
+        return children
 
+    def fresnel(self, n1, n2, cos_i):
+        # Returns (reflectivity, cos_t); cos_t is None on total internal reflection.
+        ratio = n1 / n2
+        sin_t2 = ratio * ratio * (1.0 - cos_i * cos_i)
+        if sin_t2 > 1.0:
+            return 1.0, None
+        cos_t = math.sqrt(1.0 - sin_t2)
+        r_orth = (n1 * cos_i - n2 * cos_t) / (n1 * cos_i + n2 * cos_t)
+        r_par = (n2 * cos_i - n1 * cos_t) / (n2 * cos_i + n1 * cos_t)
+        return (r_orth * r_orth + r_par * r_par) / 2.0, cos_t
 
-    def find_closest_intersection(self, scene, origin, direction):
-        closest_t = float('inf')
-        closest_hit = None
+    def refract(self, direction, normal, ratio, cos_i, cos_t):
+        return (direction * ratio + normal * (ratio * cos_i - cos_t)).normalize()
 
-        for obj in scene.objects:
-            t, normal = obj.get_intersection(origin, direction)
-            if t is not None and t > self.epsilon and t < closest_t:
-                closest_t = t
-                point  = origin + direction * t
-                closest_hit = RayHit(t, point, normal, obj)
+    def transmit(self, wavelength, direction, normal, cos_i, from_material, to_material):
+        n1 = from_material.get_ior(wavelength)
+        n2 = to_material.get_ior(wavelength)
+        reflectivity, cos_t = self.fresnel(n1, n2, cos_i)
+        if cos_t is None:
+            return None, 0.0
+        return self.refract(direction, normal, n1 / n2, cos_i, cos_t), 1.0 - reflectivity
+
+    def refract_bundle(self, bundle, point, direction, normal, cos_i, from_material, to_material, intensity, depth, parent, inside):
+        # The refracted part of a bundle stays one branch while its shortest and
+        # longest wavelengths leave within SPECTRAL_SPLIT_ANGLE of each other.
+        # IOR is monotonic in wavelength, so the two ends bound everything
+        # in between. Past that it splits into one branch per wavelength,
+        # each carrying its share of the bundle's intensity.
+        low_dir, _ = self.transmit(bundle.wavelengths[0], direction, normal, cos_i, from_material, to_material)
+        high_dir, _ = self.transmit(bundle.wavelengths[-1], direction, normal, cos_i, from_material, to_material)
+        if low_dir is None and high_dir is None:
+            return []
+
+        together = (low_dir is not None and high_dir is not None and low_dir.dot(high_dir) > 0
+                    and abs(low_dir.cross(high_dir)) <= constants.SPECTRAL_SPLIT_ANGLE)
+        parts = [bundle] if together else bundle.wavelengths
+        share = intensity if together else intensity / len(bundle)
 
+        children = []
+        for part in parts:
+            wl = bundle.hero if part is bundle else part
+            refract_dir, transmission_ratio = self.transmit(wl, direction, normal, cos_i, from_material, to_material)
+            if refract_dir is None or transmission_ratio <= 0.05:
+                continue
+            children.append((point + refract_dir * self.epsilon, refract_dir, part, share * transmission_ratio,
+                             to_material, depth + 1, parent, inside))
+        return children
+
+
+    def find_closest_intersection(self, scene, origin, direction):
+        closest_t, normal, obj = scene.get_bvh().intersect(origin, direction, self.epsilon)
+        closest_hit = None
+        if obj is not None:
+            point = origin + direction * closest_t
+            closest_hit = RayHit(closest_t, point, normal, obj, obj.material_at(point))
+        return self.closest_wall(origin, direction, closest_t, closest_hit)
 
+    def closest_wall(self, origin, direction, closest_t, closest_hit):
+        # The screen edges bound every scene; returns whichever of
+        # `closest_hit` and the wall the ray meets comes first.
         walls = [
             (Vector2D(0,0), Vector2D(0,1)),
             (Vector2D(constants.SCREEN_WIDTH, 0), Vector2D(-1, 0)),
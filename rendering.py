@@ -0,0 +1,172 @@
+import math
+from collections import OrderedDict
+import pygame
+import constants
+from utils import Vector2D, get_spectrum_color
+
+
+class SpriteCache:
+    # Least-recently-used store of pre-drawn shape sprites, keyed by
+    # everything that decides how a shape looks apart from its whole-pixel
+    # position. Sprites are dropped oldest first once their pixels take more
+    # than max_bytes; a sprite bigger than that is drawn but never kept.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.sprites = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build):
+        # (surface, offset) for key, calling build() for it on a miss.
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            self.hits += 1
+            return sprite
+        self.misses += 1
+        sprite = build()
+        size = self.size_of(sprite)
+        if size > self.max_bytes:
+            return sprite
+        self.sprites[key] = sprite
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, old = self.sprites.popitem(last=False)
+            self.bytes -= self.size_of(old)
+            self.evictions += 1
+        return sprite
+
+    def size_of(self, sprite):
+        surface = sprite[0]
+        return surface.get_pitch() * surface.get_height()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"sprites": len(self.sprites), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+SPRITES = SpriteCache(constants.SPRITE_CACHE_BYTES)
+
+
+def fill_outline(surface, points, color):
+    # Fills a closed outline with the (translucent) material colour.
+    min_x = min(p[0] for p in points)
+    max_x = max(p[0] for p in points)
+    min_y = min(p[1] for p in points)
+    max_y = max(p[1] for p in points)
+
+    w = max_x - min_x + 4
+    h = max_y - min_y + 4
+
+    if w > 0 and h > 0:
+        s = pygame.Surface((w, h), pygame.SRCALPHA)
+        offset_points = [(p[0] - min_x + 2, p[1] - min_y + 2) for p in points]
+        pygame.draw.polygon(s, color, offset_points)
+        surface.blit(s, (min_x - 2, min_y - 2))
+
+
+def outline_sprite(shape, draw):
+    # Sprite for a shape drawn from its world outline points, placed
+    # relative to the whole-pixel part of its position. Shifting every point
+    # by whole pixels rasterises the same, so the sprite only depends on
+    # the fractional part of the position, which goes in the key.
+    points = shape.get_world_data()["points"]
+    base_x = math.floor(shape.position.x)
+    base_y = math.floor(shape.position.y)
+    left = math.floor(min(p[0] for p in points)) - 4
+    top = math.floor(min(p[1] for p in points)) - 4
+    w = math.floor(max(p[0] for p in points)) - left + 5
+    h = math.floor(max(p[1] for p in points)) - top + 5
+    sprite = pygame.Surface((w, h), pygame.SRCALPHA)
+    draw(sprite, [(p[0] - left, p[1] - top) for p in points])
+    return sprite, (left - base_x, top - base_y)
+
+
+def blit_sprite(surface, shape, key, draw):
+    position = shape.position
+    key += (position.x % 1.0, position.y % 1.0, shape.material.color, shape.selected)
+    sprite, (dx, dy) = SPRITES.get(key, lambda: outline_sprite(shape, draw))
+    surface.blit(sprite, (math.floor(position.x) + dx, math.floor(position.y) + dy))
+
+
+def draw_polygon(shape, surface):
+    points = shape.get_world_data()["points"]
+
+    if not points: return
+
+    def draw(sprite, points):
+        fill_outline(sprite, points, shape.material.color)
+
+        color = constants.ACCENT if shape.selected else (100, 120, 140)
+        pygame.draw.polygon(sprite, color, points, 2)
+
+        if shape.selected:
+            for p in points:
+                pygame.draw.circle(sprite, constants.SUCCESS, p, 3)
+
+    blit_sprite(surface, shape, ("polygon", shape.geometry, shape.rotation, shape.scale), draw)
+
+
+def draw_circle_lens(shape, surface):
+    r = int(shape.world_radius())
+    x = int(shape.position.x)
+    y = int(shape.position.y)
+    selected = shape.selected
+
+    def build():
+        sprite = pygame.Surface((r*2 + 4, r*2 + 4), pygame.SRCALPHA)
+        s = pygame.Surface((r*2, r*2), pygame.SRCALPHA)
+        pygame.draw.circle(s, shape.material.color, (r, r), r)
+        sprite.blit(s, (2, 2))
+
+        color = constants.ACCENT if selected else (100, 120, 140)
+        pygame.draw.circle(sprite, color, (r + 2, r + 2), r, 2)
+        return sprite, (-r - 2, -r - 2)
+
+    sprite, (dx, dy) = SPRITES.get(("circle", r, shape.material.color, selected), build)
+    surface.blit(sprite, (x + dx, y + dy))
+
+
+def draw_thick_lens(shape, surface):
+    def draw(sprite, points):
+        fill_outline(sprite, points, shape.material.color)
+        color = constants.ACCENT if shape.selected else (100, 120, 140)
+        pygame.draw.polygon(sprite, color, points, 2)
+
+    blit_sprite(surface, shape, ("thick", shape.r1, shape.r2, shape.thickness, shape.aperture,
+                                 shape.rotation, shape.scale), draw)
+
+
+def draw_compound(shape, surface):
+    for part in shape.world_parts():
+        part.draw(surface)
+
+    bounds = shape.get_bounds()
+    if shape.selected and bounds is not None:
+        rect = pygame.Rect(int(bounds[0]) - 4, int(bounds[1]) - 4,
+                           int(bounds[2] - bounds[0]) + 8, int(bounds[3] - bounds[1]) + 8)
+        pygame.draw.rect(surface, constants.ACCENT, rect, 1)
+        pygame.draw.circle(surface, constants.SUCCESS, shape.position.to_int_tuple(), 3)
+
+
+def draw_laser(laser, surface):
+    pos = laser.position.to_int_tuple()
+    color = get_spectrum_color(laser.wavelength) if laser.active else (50, 20, 20)
+
+    def build():
+        s= pygame.Surface((100, 50,), pygame.SRCALPHA)
+        pygame.draw.rect(s, (60, 70, 80), (0, 10, 80, 30), border_radius=4)
+        pygame.draw.rect(s, (40, 50, 60), (10, 15, 60, 20))
+        pygame.draw.circle(s, color, (15, 25), 5)
+        return pygame.transform.rotate(s, -math.degrees(laser.angle)), None
+
+    rotated, _ = SPRITES.get(("laser", laser.angle, tuple(color)), build)
+    rect = rotated.get_rect(center=pos)
+    surface.blit(rotated, rect)
+
+
+    handle = laser.position - Vector2D.from_angle(laser.angle) * 60
+    pygame.draw.circle(surface, constants.LASER_HANDLE, handle.to_int_tuple(), 6)
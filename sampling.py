@@ -0,0 +1,87 @@
+import math
+import heapq
+import constants
+from utils import Vector2D
+from physics import PhysicsEngine
+
+
+class AdaptiveFan:
+    # Spread beam that spends its rays where the picture changes. A coarse
+    # fan is probed first; any gap between neighbouring rays whose hit
+    # sequences differ is bisected, widest gap first, down to
+    # ADAPTIVE_MIN_ANGLE. Sampling stops once no such gap is left or the
+    # budget is spent, so a beam that sees one thing takes the coarse fan.
+    def __init__(self, initial=None, budget=None, min_angle=None, probe_hits=None):
+        self.initial = constants.ADAPTIVE_INITIAL_RAYS if initial is None else initial
+        self.budget = constants.ADAPTIVE_RAY_BUDGET if budget is None else budget
+        self.min_angle = constants.ADAPTIVE_MIN_ANGLE if min_angle is None else min_angle
+        self.probe_hits = constants.ADAPTIVE_PROBE_HITS if probe_hits is None else probe_hits
+        self.engine = PhysicsEngine()
+        self.probes = 0
+
+    def signature(self, scene, origin, direction, wavelength):
+        # The surfaces met along the brightest path, as (object, feature)
+        # pairs; walls are told apart by their normals.
+        engine = self.engine
+        object_index = {id(obj): i for i, obj in enumerate(scene.objects)}
+        medium = scene.env_material
+        intensity = 1.0
+        hits = []
+        self.probes += 1
+        for depth in range(self.probe_hits):
+            hit = engine.find_closest_intersection(scene, origin, direction)
+            if hit is None:
+                break
+            if hit.obj == "WALL":
+                hits.append(("WALL", hit.normal.x, hit.normal.y))
+                break
+            hits.append((object_index[id(hit.obj)], hit.obj.feature_key(hit.point)))
+            children = engine.scatter(scene, hit, direction, wavelength, intensity, medium, depth, -1)
+            if not children:
+                break
+            origin, direction, wavelength, intensity, medium = max(children, key=lambda child: child[3])[:5]
+        return tuple(hits)
+
+    def sample(self, scene, laser):
+        if laser.beam_count < 2 or laser.spread <= 0 or not laser.active:
+            return laser.get_rays()
+
+        main_dir = Vector2D.from_angle(laser.angle)
+        start = laser.position + main_dir * 50
+        wavelength = laser.wavelength
+        half = math.radians((laser.beam_count - 1) / 2.0 * laser.spread)
+
+        def probe(offset):
+            return self.signature(scene, start, main_dir.rotate(offset), wavelength)
+
+        count = max(2, min(self.initial, self.budget))
+        samples = {}
+        for i in range(count):
+            offset = -half + 2 * half * i / (count - 1)
+            samples[offset] = probe(offset)
+
+        gaps = []
+
+        def add_gap(a, b):
+            if samples[a] != samples[b] and b - a >= self.min_angle:
+                heapq.heappush(gaps, (a - b, a, b))
+
+        offsets = sorted(samples)
+        for a, b in zip(offsets, offsets[1:]):
+            add_gap(a, b)
+
+        while gaps and len(samples) < self.budget:
+            _, a, b = heapq.heappop(gaps)
+            mid = (a + b) / 2.0
+            samples[mid] = probe(mid)
+            add_gap(a, mid)
+            add_gap(mid, b)
+
+        # Each ray stands for the angles closer to it than to its neighbours,
+        # the end rays also for half a pitch beyond, and carries that share
+        # of the light the laser's evenly spaced rays would, one pitch each.
+        pitch = math.radians(laser.spread)
+        offsets = sorted(samples)
+        bounds = [-half - pitch / 2.0] + [(a + b) / 2.0 for a, b in zip(offsets, offsets[1:])] + [half + pitch / 2.0]
+        return [(start, main_dir.rotate(offset), wavelength, (high - low) / pitch)
+                for offset, low, high in zip(offsets, bounds, bounds[1:])]
@@ -0,0 +1,158 @@
+import copy
+from materials import LIBRARY as MATERIALS_LIBRARY
+from bvh import SceneBVH
+from compiled import CompiledScene, source_of
+
+
+class Scene:
+    def __init__(self):
+        self.version = 0
+        self.objects = []
+        self.env_material = MATERIALS_LIBRARY["AIR"]
+        self.bvh = None
+        self._bvh_objects = None
+        self._bvh_count = 0
+        self._copies = {}
+        self._last_snapshot = None
+        self._isolated = set()
+        self._isolated_key = None
+        # Shared with every snapshot of this scene, so each compile only
+        # redoes the shapes that changed since the last one.
+        self._compiled_shared = [None]
+        self._compiled = None
+
+    @property
+    def env_material(self):
+        return self._env_material
+
+    @env_material.setter
+    def env_material(self, material):
+        self._env_material = material
+        self.version += 1
+
+    def add(self, obj):
+        self.objects.append(obj)
+        self.bvh = None
+        self.version += 1
+
+    def remove(self, obj):
+        self.objects.remove(obj)
+        self.bvh = None
+        self.version += 1
+
+    def clear(self):
+        self.objects = []
+        self.bvh = None
+        self.version += 1
+
+    def state_key(self):
+        # Changes whenever anything that can affect a trace does: membership,
+        # the environment, or any object's transform or material.
+        return (self.version, len(self.objects), tuple((id(obj), obj.version) for obj in self.objects))
+
+    def isolated_shapes(self):
+        # Ids of convex shapes whose bounds touch no other shape's bounds; a
+        # ray inside one of them can only leave through its own outline.
+        key = self.state_key()
+        if key != self._isolated_key:
+            boxes = sorted(((obj.get_bounds(), obj) for obj in self.objects if obj.get_bounds() is not None),
+                           key=lambda item: item[0][0])
+            unbounded = len(boxes) < len(self.objects)
+            touching = set()
+            active = []
+            for bounds, obj in boxes:
+                active = [(b, o) for b, o in active if b[2] >= bounds[0]]
+                for other_bounds, other in active:
+                    if other_bounds[1] <= bounds[3] and bounds[1] <= other_bounds[3]:
+                        touching.add(id(obj))
+                        touching.add(id(other))
+                active.append((bounds, obj))
+            self._isolated = set() if unbounded else {
+                id(obj) for bounds, obj in boxes if id(obj) not in touching and obj.is_convex()}
+            self._isolated_key = key
+        return self._isolated
+
+    def __getstate__(self):
+        # Snapshots sent to worker processes rebuild the BVH on first use.
+        state = dict(self.__dict__)
+        state["bvh"] = None
+        state["_bvh_objects"] = None
+        state["_copies"] = {}
+        state["_last_snapshot"] = None
+        state["_isolated_key"] = None
+        state["_compiled_shared"] = [None]
+        state["_compiled"] = None
+        return state
+
+    def snapshot(self):
+        # Read-only copy for tracing off the main thread. Shapes replace
+        # rather than mutate their tracked attributes, so a shallow copy is
+        # enough, and an unchanged shape keeps handing out the same copy.
+        copies = {}
+        objects = []
+        replaced = {}
+        for obj in self.objects:
+            cached = self._copies.get(id(obj))
+            if cached is None or cached[0] is not obj or cached[1].version != obj.version:
+                clone = copy.copy(obj)
+                clone.source = obj
+                if cached is not None and cached[0] is obj:
+                    replaced[id(cached[1])] = clone
+                cached = (obj, clone)
+            copies[id(obj)] = cached
+            objects.append(cached[1])
+        self._copies = copies
+
+        scene = Scene()
+        scene.objects = objects
+        scene._env_material = self.env_material
+        scene.version = self.version
+        scene._compiled_shared = self._compiled_shared
+        scene.bvh = self.snapshot_bvh(objects, replaced)
+        scene._bvh_objects = objects
+        scene._bvh_count = len(objects)
+        self._last_snapshot = scene
+        return scene
+
+    def snapshot_bvh(self, objects, replaced):
+        # The last snapshot's BVH with the leaves of changed shapes refitted,
+        # if it has one over the same shapes; None has the snapshot build
+        # its own. The last snapshot may still be being traced, so its tree
+        # is copied rather than refitted in place.
+        last = self._last_snapshot
+        if last is None or last.bvh is None or last._bvh_objects is not last.objects:
+            return None
+        if len(last.objects) != len(objects) or any(
+                old is not new and id(old) not in replaced for old, new in zip(last.objects, objects)):
+            return None
+        for old in last.objects:
+            new = replaced.get(id(old))
+            if new is not None and (not last.bvh.contains(old) or new.get_bounds() is None):
+                return None
+        return last.bvh.replaced(replaced)
+
+    def compiled(self):
+        # CompiledScene of the current objects; see compiled.py.
+        key = tuple((id(source_of(obj)), obj.version) for obj in self.objects)
+        if self._compiled is None or self._compiled.key != key or self._compiled.objects is not self.objects:
+            shared = self._compiled_shared[0]
+            if shared is None or shared.key != key:
+                shared = CompiledScene(self.objects, key, previous=shared)
+                self._compiled_shared[0] = shared
+            self._compiled = shared.bind(self.objects)
+        return self._compiled
+
+    def get_bvh(self):
+        # Rebuilt from scratch only when the object list itself changes;
+        # members moved or rotated since have their leaves refitted.
+        if self.bvh is None or self._bvh_objects is not self.objects or self._bvh_count != len(self.objects):
+            self.bvh = SceneBVH(self.objects)
+            self._bvh_objects = self.objects
+            self._bvh_count = len(self.objects)
+        else:
+            self.bvh.refit_stale()
+        return self.bvh
+
+    def refit(self, obj):
+        if self.bvh is not None and self.bvh.contains(obj):
+            self.bvh.refit(obj)
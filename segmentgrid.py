@@ -0,0 +1,96 @@
+import numpy as np
+from utils import clip
+
+
+class SegmentGrid:
+    # Uniform grid over the screen listing, per cell, the segments that pass
+    # within `radius` of it. Each segment is clipped to the screen (grown by
+    # the radius), sampled every `cell` pixels, and entered in every cell
+    # within radius + cell / 2 of a sample; any point within `radius` of the
+    # segment is at most that far from its nearest sample, so no neighbour
+    # is missed. Cells whose centre is more than radius plus half a cell
+    # diagonal from the segment itself are then dropped again, as no point
+    # in them can be within `radius`. Cells are stored CSR-style:
+    # `order[starts[c]:starts[c + 1]]`.
+    def __init__(self, x1, y1, x2, y2, radius, width, height, cell=16.0):
+        self.x1, self.y1 = x1, y1
+        self.sx, self.sy = x2 - x1, y2 - y1
+        with np.errstate(divide='ignore'):
+            self.inv_length2 = 1.0 / (self.sx * self.sx + self.sy * self.sy)
+        self.radius = radius
+        self.cell = cell
+        self.cols = int(np.ceil(width / cell)) + 1
+        self.rows = int(np.ceil(height / cell)) + 1
+
+        sx, sy = x2 - x1, y2 - y1
+        t0, t1 = clip(x1, y1, sx, sy, -radius, -radius, width + radius, height + radius)
+        keep = (t0 <= t1) & ((sx != 0) | (sy != 0))
+        index = np.flatnonzero(keep)
+        t0, t1 = t0[keep], t1[keep]
+        length = np.hypot(sx[keep], sy[keep]) * (t1 - t0)
+
+        samples = np.ceil(length / cell).astype(int) + 1
+        owner = np.repeat(np.arange(len(index)), samples)
+        step = np.arange(len(owner)) - np.repeat(np.cumsum(samples) - samples, samples)
+        u = t0[owner] + (t1 - t0)[owner] * step / np.maximum(samples[owner] - 1, 1)
+        seg = index[owner]
+        px = x1[seg] + sx[seg] * u
+        py = y1[seg] + sy[seg] * u
+
+        reach = radius + cell / 2.0
+        lo_c = np.clip(((px - reach) // cell).astype(int), 0, self.cols - 1)
+        hi_c = np.clip(((px + reach) // cell).astype(int), 0, self.cols - 1)
+        lo_r = np.clip(((py - reach) // cell).astype(int), 0, self.rows - 1)
+        hi_r = np.clip(((py + reach) // cell).astype(int), 0, self.rows - 1)
+        span = int(np.ceil(2 * reach / cell)) + 1
+
+        cells = []
+        owners = []
+        for dc in range(span):
+            for dr in range(span):
+                c = lo_c + dc
+                r = lo_r + dr
+                ok = (c <= hi_c) & (r <= hi_r)
+                cells.append((r * self.cols + c)[ok])
+                owners.append(seg[ok])
+        pairs = np.concatenate(cells).astype(np.int64) * max(len(x1), 1) + np.concatenate(owners)
+        pairs.sort()
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))] if len(pairs) else pairs
+        cell_of = pairs // max(len(x1), 1)
+        self.order = pairs % max(len(x1), 1)
+        centre_x = (cell_of % self.cols + 0.5) * cell
+        centre_y = (cell_of // self.cols + 0.5) * cell
+        near = self.distance(self.order, centre_x, centre_y) <= radius + cell * np.sqrt(0.5)
+        cell_of, self.order = cell_of[near], self.order[near]
+        self.starts = np.searchsorted(cell_of, np.arange(self.cols * self.rows + 1))
+
+    def pairs(self, px, py):
+        # (point index, segment index) for every segment listed in each
+        # point's cell; points off the grid get none.
+        c = (px // self.cell).astype(int)
+        r = (py // self.cell).astype(int)
+        on_grid = (c >= 0) & (c < self.cols) & (r >= 0) & (r < self.rows)
+        cell = np.where(on_grid, r * self.cols + c, 0)
+        first = self.starts[cell]
+        counts = np.where(on_grid, self.starts[cell + 1] - first, 0)
+        points = np.repeat(np.arange(len(px)), counts)
+        offsets = np.arange(len(points)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return points, self.order[np.repeat(first, counts) + offsets]
+
+    def distance(self, segs, qx, qy):
+        # Distance from each point (qx, qy) to segment segs[i].
+        qx = qx - self.x1[segs]
+        qy = qy - self.y1[segs]
+        sx, sy = self.sx[segs], self.sy[segs]
+        t = qx * sx
+        t += qy * sy
+        t *= self.inv_length2[segs]
+        np.clip(t, 0, 1, out=t)
+        qx -= sx * t
+        qy -= sy * t
+        return np.hypot(qx, qy, out=qx)
+
+    def distances(self, px, py):
+        # (point index, segment index, distance) for the candidate pairs.
+        points, segs = self.pairs(px, py)
+        return points, segs, self.distance(segs, px[points], py[points])
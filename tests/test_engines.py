@@ -0,0 +1,149 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import constants
+from utils import Vector2D, Spectrum
+from materials import LIBRARY
+from objects import Polygon, CircleLens, CompoundShape, LaserSource
+from scene import Scene
+from buffers import SegmentBuffer
+from physics import PhysicsEngine
+from wavefront import WavefrontEngine
+from parallel import ParallelEngine
+from incremental import IncrementalTracer
+from beams import BeamTracer
+
+# Every engine must lay down the same segments as PhysicsEngine, the
+# reference. Engines emit them in their own order and number parents
+# differently, so segments are compared as sorted rows of geometry, light
+# and depth.
+COLUMNS = ("x1", "y1", "x2", "y2", "intensity", "wavelength", "depth")
+
+
+def default_scene():
+    scene = Scene()
+    scene.add(Polygon(500, 450, LIBRARY["GLASS"], [(-60, 50), (60, 50), (0, -50)]))
+    scene.add(Polygon(800, 450, LIBRARY["WATER"], [(-50, -80), (50, -80), (50, 80), (-50, 80)]))
+    scene.add(CircleLens(650, 200, LIBRARY["DIAMOND"], 60))
+    return scene
+
+
+def compound_scene():
+    scene = default_scene()
+    scene.add(CompoundShape(1000, 300, [
+        Polygon(-40, 0, LIBRARY["GLASS"], [(-30, -60), (30, -60), (30, 60), (-30, 60)]),
+        CircleLens(40, 0, LIBRARY["GLASS"], 40),
+    ]))
+    return scene
+
+
+def fan(count=10, spread=2.0, angle=0.0, wavelength=650):
+    laser = LaserSource(100, constants.SCREEN_HEIGHT // 2)
+    laser.angle = angle
+    laser.beam_count = count
+    laser.spread = spread
+    laser.wavelength = wavelength
+    return laser.get_rays()
+
+
+def white():
+    direction = Vector2D.from_angle(0.0)
+    start = Vector2D(100, constants.SCREEN_HEIGHT // 2) + direction * 50
+    return [(start, direction, Spectrum.white(constants.WHITE_LIGHT_BINS), 1.0)]
+
+
+def rows(segments):
+    columns = segments.columns()
+    table = np.stack([columns[name].astype(float) for name in COLUMNS], axis=1)
+    return table[np.lexsort(np.round(table, 6).T[::-1])]
+
+
+def reference(scene, rays):
+    result = PhysicsEngine().solve_scene(scene, rays, out=SegmentBuffer())
+    assert result.culled_branches == 0
+    return result.segments
+
+
+def assert_same(segments, expected):
+    assert len(segments) == len(expected)
+    np.testing.assert_allclose(rows(segments), rows(expected), rtol=0, atol=1e-6)
+
+
+@pytest.fixture(params=["wavefront", "parallel", "incremental", "beam"])
+def tracer(request):
+    if request.param == "wavefront":
+        yield WavefrontEngine()
+    elif request.param == "parallel":
+        # Always through the worker processes, however few the rays.
+        engine = ParallelEngine(workers=2, min_rays=1)
+        yield engine
+        engine.close()
+    elif request.param == "incremental":
+        yield IncrementalTracer(PhysicsEngine())
+    else:
+        yield BeamTracer(PhysicsEngine())
+
+
+@pytest.mark.parametrize("scene, rays", [
+    (default_scene, lambda: fan(count=1)),
+    (default_scene, fan),
+    (default_scene, lambda: fan(count=6, spread=4.0, angle=-0.3)),
+    (default_scene, white),
+    (compound_scene, fan),
+    (compound_scene, white),
+], ids=["single", "fan", "wide fan", "white", "compound fan", "compound white"])
+def test_matches_reference(tracer, scene, rays):
+    scene, rays = scene(), rays()
+    out = tracer.solve_scene(scene, rays, out=SegmentBuffer()).segments
+    assert_same(out, reference(scene, rays))
+
+
+@pytest.mark.parametrize("rays", [fan, white], ids=["fan", "white"])
+def test_matches_reference_after_edits(tracer, rays):
+    # Engines that keep state from one trace to the next must not let it
+    # leak past an edit.
+    scene, rays = compound_scene(), rays()
+    tracer.solve_scene(scene, rays, out=SegmentBuffer())
+    edits = [
+        lambda: setattr(scene.objects[0], "position", Vector2D(520, 430)),
+        lambda: setattr(scene.objects[1], "rotation", 0.4),
+        lambda: setattr(scene.objects[3], "material", LIBRARY["DIAMOND"]),
+        lambda: scene.add(Polygon(300, 420, LIBRARY["GLASS"], [(-20, -20), (20, -20), (20, 20), (-20, 20)])),
+        lambda: scene.remove(scene.objects[2]),
+        lambda: setattr(scene, "env_material", LIBRARY["WATER"]),
+    ]
+    for edit in edits:
+        edit()
+        out = tracer.solve_scene(scene, rays, out=SegmentBuffer()).segments
+        assert_same(out, reference(scene, rays))
+
+
+def test_beam_covers_parallel_bundle():
+    # A parallel bundle is traced as one beam: its outermost rays come out
+    # as segments exactly as PhysicsEngine traces them, and every segment
+    # of the rays in between lies within the beam's quads.
+    scene = compound_scene()
+    rays = fan(count=8, spread=0.0, angle=-0.1)
+    out = BeamTracer(PhysicsEngine()).solve_scene(scene, rays, out=SegmentBuffer()).segments
+    assert len(out.beams)
+
+    beam_rows = rows(out)
+    for ray in (rays[0], rays[-1]):
+        for row in rows(reference(scene, [ray])):
+            assert np.abs(beam_rows - row).max(axis=1).min() < 1e-6
+
+    quads = out.beams.columns()
+    xs = np.stack([quads[name] for name in ("x1", "x2", "x3", "x4")], axis=1)
+    ys = np.stack([quads[name] for name in ("y1", "y2", "y3", "y4")], axis=1)
+    inner = reference(scene, rays[1:-1]).columns()
+    for px, py in zip((inner["x1"] + inner["x2"]) / 2, (inner["y1"] + inner["y2"]) / 2):
+        # Inside (or on the edge of) some convex quad: on the same side of
+        # all four of its edges.
+        cross = (np.roll(xs, -1, axis=1) - xs) * (py - ys) - (np.roll(ys, -1, axis=1) - ys) * (px - xs)
+        inside = np.all(cross >= -1e-6, axis=1) | np.all(cross <= 1e-6, axis=1)
+        assert inside.any()
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 class Vector2D:
     def __init__(self, x, y):
@@ -71,7 +72,7 @@ class Vector2D:
 
 
 
-def get_spectrum_color(wavelength):
+def spectrum_curve(wavelength):
     w = float(wavelength)
     if w < 380: w = 380
     if w > 780: w = 780
@@ -98,7 +99,99 @@ def get_spectrum_color(wavelength):
         factor = 0.3 + 0.7 * (780 - w) / (780 - 700)
 
     gamma = 0.8
-    R = int(max(0, (r * factor) ** gamma) * 255)
-    G = int(max(0, (g * factor) ** gamma) * 255)
-    B = int(max(0, (b * factor) ** gamma) * 255)
-    return (R, G, B)
\ No newline at end of file
+    R = max(0, (r * factor) ** gamma) * 255
+    G = max(0, (g * factor) ** gamma) * 255
+    B = max(0, (b * factor) ** gamma) * 255
+    return (R, G, B)
+
+
+def compute_spectrum_color(wavelength):
+    r, g, b = spectrum_curve(wavelength)
+    return (int(r), int(g), int(b))
+
+
+# Wavelengths the spectrum colour table is sampled at, 0.1 nm apart.
+SPECTRUM_MIN = 380.0
+SPECTRUM_MAX = 780.0
+SAMPLES_PER_NM = 10
+SPECTRUM_GRID = np.linspace(SPECTRUM_MIN, SPECTRUM_MAX, int((SPECTRUM_MAX - SPECTRUM_MIN) * SAMPLES_PER_NM) + 1)
+
+_spectrum_table = None
+_spectrum_rows = None
+
+
+def _build_spectrum_table():
+    global _spectrum_table, _spectrum_rows
+    # Kept as floats (before the final int()) so neighbouring samples blend.
+    _spectrum_rows = [spectrum_curve(w) for w in SPECTRUM_GRID.tolist()]
+    _spectrum_table = np.array(_spectrum_rows)
+
+
+def get_spectrum_color(wavelength):
+    if _spectrum_rows is None:
+        _build_spectrum_table()
+    x = (wavelength - SPECTRUM_MIN) * SAMPLES_PER_NM
+    last = len(_spectrum_rows) - 1
+    if x <= 0:
+        r, g, b = _spectrum_rows[0]
+        return (int(r), int(g), int(b))
+    if x >= last:
+        r, g, b = _spectrum_rows[last]
+        return (int(r), int(g), int(b))
+    i = int(x)
+    f = x - i
+    r0, g0, b0 = _spectrum_rows[i]
+    r1, g1, b1 = _spectrum_rows[i + 1]
+    return (int(r0 + (r1 - r0) * f), int(g0 + (g1 - g0) * f), int(b0 + (b1 - b0) * f))
+
+
+def get_spectrum_colors(wavelengths):
+    if _spectrum_table is None:
+        _build_spectrum_table()
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    channels = [np.interp(wavelengths, SPECTRUM_GRID, _spectrum_table[:, c]) for c in range(3)]
+    return np.stack(channels, axis=-1).astype(np.uint8)
+
+
+class Spectrum:
+    # Several wavelengths travelling as one ray while their paths agree.
+    # The hero wavelength decides the shared geometry; `color` is the blend
+    # of all of them, scaled so the brightest channel is full.
+    def __init__(self, wavelengths):
+        self.wavelengths = tuple(float(w) for w in wavelengths)
+        self.hero = self.wavelengths[len(self.wavelengths) // 2]
+        mix = get_spectrum_colors(self.wavelengths).astype(float).sum(axis=0)
+        peak = mix.max()
+        if peak > 0:
+            mix = mix * (255.0 / peak)
+        self.color = tuple(int(c) for c in mix)
+
+    @staticmethod
+    def white(bins, low=400.0, high=700.0):
+        return Spectrum(np.linspace(low, high, bins).tolist())
+
+    def __len__(self):
+        return len(self.wavelengths)
+
+    def __iter__(self):
+        return iter(self.wavelengths)
+
+    def __eq__(self, other):
+        return isinstance(other, Spectrum) and self.wavelengths == other.wavelengths
+
+    def __hash__(self):
+        return hash(self.wavelengths)
+
+
+def clip(x, y, dx, dy, min_x, min_y, max_x, max_y):
+    # Liang-Barsky: parameter range of each segment inside the box.
+    t0 = np.zeros(len(x))
+    t1 = np.ones(len(x))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x - min_x), (dx, max_x - x), (-dy, y - min_y), (dy, max_y - y)):
+            r = q / p
+            t0 = np.where(p < 0, np.maximum(t0, r), t0)
+            t1 = np.where(p > 0, np.minimum(t1, r), t1)
+            outside = (p == 0) & (q < 0)
+            t1 = np.where(outside, -1.0, t1)
+    return t0, t1
@@ -0,0 +1,216 @@
+import numpy as np
+import constants
+from utils import Vector2D, Spectrum, get_spectrum_colors
+from physics import RaySegment, TraceResult
+from buffers import SegmentBuffer, pack_colors
+
+
+class WavefrontEngine:
+    # Same optics as PhysicsEngine, but every live ray of one bounce depth is
+    # advanced together as a set of NumPy arrays instead of one recursive call
+    # per ray. Segments come out breadth-first rather than depth-first.
+    def __init__(self, segment_budget=None):
+        self.epsilon = 0.001
+        self.segment_budget = constants.SEGMENT_BUDGET if segment_budget is None else segment_budget
+        self.should_stop = None
+
+    def solve_scene(self, scene, ray_origins, out=None):
+        if out is None:
+            all_segments = []
+        else:
+            all_segments = out
+            all_segments.clear()
+        if not ray_origins:
+            return TraceResult(all_segments)
+
+        compiled = scene.compiled()
+        # Medium 0 is the environment; material m of the compiled scene is m + 1.
+        materials = [scene.env_material] + compiled.materials
+        ior_base = np.array([m.ior_base for m in materials])
+        dispersion = np.array([m.dispersion for m in materials])
+        opacity = np.array([m.opacity for m in materials])
+
+        ox = np.array([o.x for o, d, wl, i in ray_origins])
+        oy = np.array([o.y for o, d, wl, i in ray_origins])
+        dx = np.array([d.x for o, d, wl, i in ray_origins])
+        dy = np.array([d.y for o, d, wl, i in ray_origins])
+        # Spectral bundles travel under their hero wavelength; `bundle` indexes
+        # `spectra` for them and is -1 for ordinary rays.
+        spectra = list({wl for o, d, wl, i in ray_origins if isinstance(wl, Spectrum)})
+        spectrum_index = {spectrum: i for i, spectrum in enumerate(spectra)}
+        bundle = np.array([spectrum_index.get(wl, -1) if isinstance(wl, Spectrum) else -1 for o, d, wl, i in ray_origins])
+        wavelength = np.array([wl.hero if isinstance(wl, Spectrum) else float(wl) for o, d, wl, i in ray_origins])
+        intensity = np.array([float(i) for o, d, wl, i in ray_origins])
+        medium = np.zeros(len(ray_origins), dtype=int)
+        parent = -1 - np.arange(len(ray_origins))
+
+        culled = 0
+        depth = 0
+        while len(ox) > 0 and depth <= constants.MAX_RECURSION:
+            if self.should_stop is not None and self.should_stop():
+                return TraceResult(all_segments, len(ox), cancelled=True)
+            live = intensity >= constants.MIN_INTENSITY
+            remaining = self.segment_budget - len(all_segments)
+            if live.sum() > remaining:
+                # Over budget: keep only the brightest rays of this wavefront.
+                culled += int(live.sum()) - max(remaining, 0)
+                brightest = np.argsort(-np.where(live, intensity, -1.0), kind='stable')[:max(remaining, 0)]
+                live = np.zeros(len(ox), dtype=bool)
+                live[brightest] = True
+            if not live.all():
+                ox, oy, dx, dy = ox[live], oy[live], dx[live], dy[live]
+                wavelength, intensity, medium, parent = wavelength[live], intensity[live], medium[live], parent[live]
+                bundle = bundle[live]
+                if len(ox) == 0:
+                    break
+
+            t, nx, ny, hit_obj, hit_material = self.find_closest_intersections(compiled, ox, oy, dx, dy)
+
+            missed = hit_obj == -1
+            hit = ~missed
+            t_draw = np.where(missed, constants.RAY_STEP, t)
+            end_x = ox + dx * t_draw
+            end_y = oy + dy * t_draw
+
+            dist = np.hypot(end_x - ox, end_y - oy)
+            final_intensity = np.where(hit, intensity * np.exp(-opacity[medium] * (dist / 100.0)), intensity)
+            first = self.emit(all_segments, ox, oy, end_x, end_y, final_intensity, wavelength, depth, parent,
+                              np.maximum(hit_obj, -1), bundle, spectra)
+            index = first + np.arange(len(ox))
+
+            bounce = hit_obj >= 0
+            if not bounce.any():
+                break
+
+            ox, oy, dx, dy = end_x[bounce], end_y[bounce], dx[bounce], dy[bounce]
+            nx, ny, obj_medium = nx[bounce], ny[bounce], hit_material[bounce] + 1
+            wavelength, intensity, medium = wavelength[bounce], final_intensity[bounce], medium[bounce]
+            bundle = bundle[bounce]
+            index = index[bounce]
+
+            is_entering = dx * nx + dy * ny < 0
+            from_medium = np.where(is_entering, medium, obj_medium)
+            to_medium = np.where(is_entering, obj_medium, 0)
+            nx = np.where(is_entering, nx, -nx)
+            ny = np.where(is_entering, ny, -ny)
+
+            wl_um = wavelength / 1000.0
+            n1 = ior_base[from_medium] + dispersion[from_medium] / (wl_um ** 2)
+            n2 = ior_base[to_medium] + dispersion[to_medium] / (wl_um ** 2)
+            reflectivity, is_tir, tx, ty = self.interface(dx, dy, nx, ny, n1, n2)
+
+            d_dot_n = dx * nx + dy * ny
+            rx, ry = self.normalize(dx - nx * (2 * d_dot_n), dy - ny * (2 * d_dot_n))
+            reflect = reflectivity > 0.05
+
+            transmission_ratio = 1.0 - reflectivity
+            refract = ~is_tir & (transmission_ratio > 0.05)
+
+            split = self.dispersed_bundles(bundle, spectra, dx, dy, nx, ny, from_medium, to_medium, ior_base, dispersion)
+            refract &= ~split
+            rows = np.flatnonzero(split)
+            counts = [len(spectra[b]) for b in bundle[rows].tolist()]
+            rows = np.repeat(rows, counts)
+            # Each wavelength of a split bundle carries its share of the light.
+            share = np.repeat(1.0 / np.array(counts, dtype=float), counts)
+            split_wl = np.array([w for b in bundle[split].tolist() for w in spectra[b].wavelengths], dtype=float)
+            split_um = split_wl / 1000.0
+            split_n1 = ior_base[from_medium[rows]] + dispersion[from_medium[rows]] / (split_um ** 2)
+            split_n2 = ior_base[to_medium[rows]] + dispersion[to_medium[rows]] / (split_um ** 2)
+            split_r, split_tir, sx, sy = self.interface(dx[rows], dy[rows], nx[rows], ny[rows], split_n1, split_n2)
+            keep = ~split_tir & (1.0 - split_r > 0.05)
+            rows, split_wl, split_r, sx, sy = rows[keep], split_wl[keep], split_r[keep], sx[keep], sy[keep]
+            share = share[keep]
+
+            ox = np.concatenate((ox[reflect] + rx[reflect] * self.epsilon, ox[refract] + tx[refract] * self.epsilon,
+                                 ox[rows] + sx * self.epsilon))
+            oy = np.concatenate((oy[reflect] + ry[reflect] * self.epsilon, oy[refract] + ty[refract] * self.epsilon,
+                                 oy[rows] + sy * self.epsilon))
+            dx = np.concatenate((rx[reflect], tx[refract], sx))
+            dy = np.concatenate((ry[reflect], ty[refract], sy))
+            wavelength = np.concatenate((wavelength[reflect], wavelength[refract], split_wl))
+            intensity = np.concatenate((intensity[reflect] * reflectivity[reflect],
+                                        intensity[refract] * transmission_ratio[refract],
+                                        intensity[rows] * share * (1.0 - split_r)))
+            medium = np.concatenate((medium[reflect], to_medium[refract], to_medium[rows]))
+            parent = np.concatenate((index[reflect], index[refract], index[rows]))
+            bundle = np.concatenate((bundle[reflect], bundle[refract], np.full(len(rows), -1)))
+            depth += 1
+
+        return TraceResult(all_segments, culled)
+
+    def interface(self, dx, dy, nx, ny, n1, n2):
+        # Fresnel reflectivity, total internal reflection and the refracted
+        # direction for rays meeting a surface whose normal faces them.
+        ratio = n1 / n2
+        cos_i = -(nx * dx + ny * dy)
+        sin_t2 = ratio * ratio * (1.0 - cos_i * cos_i)
+        is_tir = sin_t2 > 1.0
+
+        cos_t = np.sqrt(np.maximum(0.0, 1.0 - sin_t2))
+        r_orth = (n1 * cos_i - n2 * cos_t) / (n1 * cos_i + n2 * cos_t)
+        r_par = (n2 * cos_i - n1 * cos_t) / (n2 * cos_i + n1 * cos_t)
+        reflectivity = np.where(is_tir, 1.0, (r_orth * r_orth + r_par * r_par) / 2.0)
+
+        k = np.maximum(0.0, 1.0 - ratio * ratio * (1.0 - cos_i * cos_i))
+        tx, ty = self.normalize(dx * ratio + nx * (ratio * cos_i - np.sqrt(k)),
+                                dy * ratio + ny * (ratio * cos_i - np.sqrt(k)))
+        return reflectivity, is_tir, tx, ty
+
+    def dispersed_bundles(self, bundle, spectra, dx, dy, nx, ny, from_medium, to_medium, ior_base, dispersion):
+        # Bundles whose shortest and longest wavelengths refract more than
+        # SPECTRAL_SPLIT_ANGLE apart; their refracted part goes per wavelength.
+        split = np.zeros(len(bundle), dtype=bool)
+        rows = np.flatnonzero(bundle >= 0)
+        if len(rows) == 0:
+            return split
+        directions = []
+        for end in (0, -1):
+            wl_um = np.array([spectra[b].wavelengths[end] for b in bundle[rows].tolist()]) / 1000.0
+            n1 = ior_base[from_medium[rows]] + dispersion[from_medium[rows]] / (wl_um ** 2)
+            n2 = ior_base[to_medium[rows]] + dispersion[to_medium[rows]] / (wl_um ** 2)
+            directions.append(self.interface(dx[rows], dy[rows], nx[rows], ny[rows], n1, n2)[1:])
+        (low_tir, lx, ly), (high_tir, hx, hy) = directions
+        together = (~low_tir & ~high_tir & (lx * hx + ly * hy > 0) &
+                    (np.abs(lx * hy - ly * hx) <= constants.SPECTRAL_SPLIT_ANGLE))
+        split[rows] = ~together
+        return split
+
+    def emit(self, output, x1, y1, x2, y2, intensity, wavelength, depth, parent, hit, bundle=None, spectra=()):
+        colors = get_spectrum_colors(wavelength)
+        if bundle is not None and (bundle >= 0).any():
+            colors[bundle >= 0] = np.array([spectra[b].color for b in bundle[bundle >= 0].tolist()], dtype=np.uint8)
+        if isinstance(output, SegmentBuffer):
+            packed = pack_colors(colors)
+            return output.extend(x1=x1, y1=y1, x2=x2, y2=y2, intensity=intensity, wavelength=wavelength,
+                                 color=packed, depth=depth, parent=parent, hit=hit)
+
+        first = len(output)
+        for i in range(len(x1)):
+            output.append(RaySegment(Vector2D(x1[i], y1[i]), Vector2D(x2[i], y2[i]),
+                                     float(intensity[i]), float(wavelength[i]), tuple(colors[i].tolist())))
+        return first
+
+    def normalize(self, x, y):
+        m = np.hypot(x, y)
+        m = np.where(m == 0, 1.0, m)
+        return x / m, y / m
+
+    def find_closest_intersections(self, compiled, ox, oy, dx, dy):
+        closest_t, nx, ny, hit_obj, hit_material = compiled.intersect(ox, oy, dx, dy, self.epsilon)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            walls = (
+                (dy < 0, -oy / dy, 0.0, 1.0),
+                (dy > 0, (constants.SCREEN_HEIGHT - oy) / dy, 0.0, -1.0),
+                (dx < 0, -ox / dx, 1.0, 0.0),
+                (dx > 0, (constants.SCREEN_WIDTH - ox) / dx, -1.0, 0.0),
+            )
+        for facing, t, wall_nx, wall_ny in walls:
+            closer = facing & (t > self.epsilon) & (t < closest_t)
+            closest_t = np.where(closer, t, closest_t)
+            nx = np.where(closer, wall_nx, nx)
+            ny = np.where(closer, wall_ny, ny)
+            hit_obj = np.where(closer, -2, hit_obj)
+
+        return closest_t, nx, ny, hit_obj, hit_material